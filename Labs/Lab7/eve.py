@@ -47,7 +47,7 @@ The author would be very happy to hear of improvements or enhancements
 that you may make to EVE.
 """
 from __future__ import division, print_function
-import math, numpy, os, platform, re, struct, sys, tempfile
+import atexit, bisect, collections, io, math, numpy, os, platform, re, shlex, subprocess, sys, tempfile
 
 #-------------------------------------------------------------------------------
 # TO DO
@@ -66,6 +66,66 @@ tiny = 1.0e-7            # the smallest number worth bothering about
 huge = 1.0e99            # a really large number
 max_image_value = 255.0  # the largest value normally put into an image
 
+# Peaks held as three parallel arrays of heights, y- and x-positions, as
+# returned by peak_arrays().
+PeakArrays = collections.namedtuple ("PeakArrays", "h y x")
+
+# The ways in which insert() can combine a region with an image, indexed by
+# its `operation` argument; each updates the destination `d` in place.
+insert_operations = {
+    '=': lambda d, s: numpy.copyto (d, s, casting='unsafe'),
+    '+': lambda d, s: numpy.add (d, s, out=d),
+    '-': lambda d, s: numpy.subtract (d, s, out=d),
+    '*': lambda d, s: numpy.multiply (d, s, out=d),
+    '/': lambda d, s: numpy.divide (d, s, out=d),
+}
+
+# The routines that display() and graph() call for each graphics subsystem,
+# indexed by the value of `use_graphics`.
+display_routines = {
+    'default': lambda im, stretch, bgr, name, wait:
+        display_external (im, stretch=stretch, bgr=bgr, name=name, wait=wait),
+    'sixel': lambda im, stretch, bgr, name, wait:
+        display_sixel (im, stretch=stretch, bgr=bgr, name=name),
+    'tty': lambda im, stretch, bgr, name, wait: lppic (im, [" ./WX#"], width=80),
+    'lp': lambda im, stretch, bgr, name, wait: lppic (im),
+}
+
+graph_routines = {
+    'default': lambda x, y, xlabel, ylabel, title, logx, logy, style:
+        graph_gnuplot (x, y, xlabel, ylabel, title, logx=logx, logy=logy,
+                       style=style),
+    'sixel': lambda x, y, xlabel, ylabel, title, logx, logy, style:
+        _graph_sixel (x, y, xlabel, ylabel, title, logx, logy, style),
+    'tty': lambda x, y, xlabel, ylabel, title, logx, logy, style:
+        lpgraph (x, y, xlabel, ylabel, title, logx=logx, logy=logy,
+                 style=style),
+}
+
+# Kernels that have been compiled by _jit(), indexed by the Python routine.
+_jitted = {}
+
+# The gnuplot process kept running by graph_gnuplot() for graphs that need
+# not wait for the user, closed by close_gnuplot() or at exit.
+_gnuplot = None
+
+# Results of find_in_path(), indexed by the search path and program name.
+_path_cache = {}
+
+# The kernel and means last used by pca_project(), along with the projection
+# of the means, which is the same for every image projected with them.
+_pca_offset = None
+
+# The invocation of the program found by display_sixel() for displaying
+# sixels, looked for only until one is found.
+_sixel_program = None
+
+# Keypoints already read by sift_keypoints(), indexed by the absolute name
+# of the file they came from and stored with its modification time.  Only
+# the most recently used sift_cache_size files are remembered.
+_sift_cache = collections.OrderedDict ()
+sift_cache_size = 32
+
 character_height = 13    # height of characters in draw_text()
 character_width = 10     # width of characters in draw_text()
 character_bitmap = {
@@ -581,25 +641,29 @@ def compare_lists (l1, l2, tol):
     return ndiff
 
 #-------------------------------------------------------------------------------
-def contrast_stretch (im, low=0.0, high=max_image_value):
+def contrast_stretch (im, low=0.0, high=max_image_value, out=None):
     """
     Stretch the contrast in the image to the supplied low and high values.
 
     Arguments:
-      im  image whose contrast is to be stretched (modified)
+      im  image whose contrast is to be stretched (modified unless out
+          is supplied)
      low  new value to which the lowest value in im is to be scaled
           (default: 0.0)
     high  new value to which the highest value in im is to be scaled
           (default: max_image_value)
+     out  if supplied, an image of the same size as im into which the
+          stretched image is written, leaving im alone (default: None)
     """
     oldmin, oldmax = extrema (im)
     fac = (high - low) / (oldmax - oldmin)
     # For some reason, the following line doesn't work but the subsequent
     # three do!
     # im = (im - oldmin) * fac + low
-    im -= oldmin
-    im *= fac
-    im += low
+    if out is None: out = im
+    numpy.subtract (im, oldmin, out=out)
+    out *= fac
+    out += low
 
 #-------------------------------------------------------------------------------
 def convolve (im, mask, statistic='sum'):
@@ -626,6 +690,23 @@ def convolve (im, mask, statistic='sum'):
     # Create an output image of the same size as the input.
     result = image (im)
 
+    # A grey-scale shrink or expand with a mask containing only zeros and
+    # ones is simply the minimum or maximum over the non-zero elements of
+    # the mask, which scipy's compiled filters calculate much faster.  The
+    # loop below weights the pixels under the mask's zeros by zero rather
+    # than ignoring them, though, which gives a different answer when the
+    # image has negative values; so if the mask has zeros, the filters are
+    # used only for non-negative images.  A mask of nothing but zeros is
+    # also left to the loop, which has its own answer for that case.
+    if statistic in ("min", "max") and numpy.isin (mask, (0, 1)).all () \
+       and mask.any () and (mask.all () or im.min () >= 0):
+        import scipy.ndimage
+        ndfilter = scipy.ndimage.minimum_filter if statistic == "min" \
+                   else scipy.ndimage.maximum_filter
+        ndfilter (im[:,:,0], footprint=(mask[:,:,0] != 0), mode="wrap",
+                  output=result[:,:,0])
+        return result
+
     # We need a special case for 'min' statistic to erase the mask elements
     # that are zero.
     nzeros = len ([x for x in mask.ravel() if x == 0])
@@ -716,17 +797,15 @@ def correlation_coefficient (im1, im2):
     im1 = reshape3 (im1)
     ny, nx, nc = sizes (im1)
     im2 = reshape3 (im2)
-    sumx = sumy = sumxx = sumyy = sumxy = 0.0
-    for y in range (0, ny):
-        for x in range (0, nx):
-            for c in range (0, nc):
-                v1 = im1[y,x,c]
-                v2 = im2[y,x,c]
-                sumx += v1
-                sumy += v2
-                sumxx += v1 * v1
-                sumxy += v1 * v2
-                sumyy += v2 * v2
+    # The sums are accumulated in double precision, the products as scalar
+    # products of the flattened images.
+    x1 = numpy.ravel (im1).astype (numpy.float64)
+    x2 = numpy.ravel (im2).astype (numpy.float64)
+    sumx = x1.sum ()
+    sumy = x2.sum ()
+    sumxx = numpy.dot (x1, x1)
+    sumxy = numpy.dot (x1, x2)
+    sumyy = numpy.dot (x2, x2)
     n = ny * nx * nc
     v1 = sumxy - sumx * sumy / n
     v2 = math.sqrt((sumxx-sumx*sumx/n) * (sumyy-sumy*sumy/n))
@@ -1827,13 +1906,21 @@ def find_in_path (prog):
     Arguments:
     prog  program whose absolute filename is to be found
     """
-    # First, split the PATH variable into a list of directories, then find
-    # the first program from our list that is in the path.
-    path = os.environ['PATH'].split (os.pathsep)
-    for p in path:
+    # Programs are looked for repeatedly (every time an image is displayed,
+    # for example), so remember what was found for the current search path.
+    key = (os.environ['PATH'], prog)
+    if key in _path_cache: return _path_cache[key]
+
+    # Split the PATH variable into a list of directories, then find the
+    # first program from our list that is in the path.
+    result = None
+    for p in key[0].split (os.pathsep):
         fp = os.path.join(p, prog)
-        if os.path.exists(fp): return os.path.abspath(fp)
-    return None
+        if os.path.exists(fp):
+            result = os.path.abspath(fp)
+            break
+    _path_cache[key] = result
+    return result
 
 #-------------------------------------------------------------------------------
 def find_peaks (im, threshold):
@@ -2275,15 +2362,17 @@ def hough_line (im, nr=300, na=200, threshold=10, max_peaks=None,
     if disp:
         nn = max (ny, nx)
         d = make_three_channel (im)
-        for val, r, a in peaks[0:max_peaks]:
-            radius = rvals[r]
-            angle = avals[a]
-            x0 = int (radius * math.cos (angle))
-            y0 = int (radius * math.sin (angle))
-            x1 = x0 - int (nn * math.sin(angle))
-            y1 = y0 + int (nn * math.cos(angle))
-            x2 = x0 + int (nn * math.sin(angle))
-            y2 = y0 - int (nn * math.cos(angle))
+        # Work out the end-points of all the lines in one go, then draw them.
+        pk = peak_arrays (peaks[0:max_peaks])
+        radii = numpy.array (rvals)[pk.y]
+        angles = numpy.array (avals)[pk.x]
+        ca = numpy.cos (angles)
+        sa = numpy.sin (angles)
+        x0 = (radii * ca).astype (int)
+        y0 = (radii * sa).astype (int)
+        dx = (nn * sa).astype (int)
+        dy = (nn * ca).astype (int)
+        for x1, y1, x2, y2 in zip (x0 - dx, y0 + dy, x0 + dx, y0 - dy):
             draw_line (d, y1, x1, y2, x2, v)
         display (d, name="Lines from Hough peaks")
 
@@ -2348,8 +2437,9 @@ def image (fromwhat, type=numpy.float32):
         pic = Image.open (fn)
         # Something seems to be broken with at least 16-bit TIFFs...
         if pic.mode == "I;16":
-            temp = numpy.fromstring(pic.tostring(), dtype=numpy.uint16)
-            im = numpy.asarray (temp, dtype=type)
+            nx, ny = pic.size
+            temp = numpy.frombuffer (pic.tobytes (), dtype="<u2")
+            im = temp.reshape (ny, nx, 1).astype (type)
             nc = 1
         else:
             im = numpy.asarray (pic, dtype=type)
@@ -2432,18 +2522,9 @@ def insert (im, reg, yc, xc, operation='='):
     yhi = ylo + ny
     xlo = xc - nx // 2
     xhi = xlo + nx
-    if operation == '=':
-        im[ylo:yhi,xlo:xhi,:] = reg
-    elif operation == '+':
-        im[ylo:yhi,xlo:xhi,:] += reg
-    elif operation == '-':
-        im[ylo:yhi,xlo:xhi,:] -= reg
-    elif operation == '*':
-        im[ylo:yhi,xlo:xhi,:] *= reg
-    elif operation == '/':
-        im[ylo:yhi,xlo:xhi,:] /= reg
-    else:
+    if not operation in insert_operations:
         raise ValueError ('Invalid operation type')
+    insert_operations[operation] (im[ylo:yhi,xlo:xhi,:], reg)
 
 #-------------------------------------------------------------------------------
 def invoke_image_program (category, delete=True, im=None):
@@ -2524,93 +2605,85 @@ def label_regions_slow (im, con8=True):
     im = reshape3 (im)
     ny, nx, nc = sizes (im)
     lab = image ((ny, nx, nc), type=numpy.int32)
-    vals = [0, 0, 0, 0]
-    labs = [1, 0, 0, 0]
 
-    # The upper left pixel is in region zero.
+    # Indexing numpy arrays one pixel at a time is very slow, so the scan
+    # is done on plain Python lists holding the first channel.
+    pix = im[:,:,0].tolist ()
+    labs = [[0] * nx for y in range (0, ny)]
+
+    # Equivalences between labels are held in a union-find forest: `parent`
+    # links each label towards the root of its set and `rank` bounds the
+    # depth of each tree.  The upper left pixel is in region zero.
     lastlabel = 0
-    equiv = [lastlabel]
-    lab[0,0,0] = lastlabel
+    parent = [lastlabel]
+    rank = [0]
 
     # Process the rest of the first row of the image.
-    y = 0
+    row = pix[0]
+    lrow = labs[0]
     for x in range (1, nx):
-        if im[y,x,0] != im[y,x-1,0]:
+        if row[x] != row[x-1]:
             lastlabel += 1
-            equiv.append (lastlabel)
-        lab[y,x,0] = lastlabel
+            parent.append (lastlabel)
+            rank.append (0)
+        lrow[x] = lastlabel
 
     # Process the first column of the image.
-    x = 0
     for y in range (1, ny):
-        if im[y,x,0] == im[y-1,x,0]:
-            lv = lab[y-1,x,0]
+        if pix[y][0] == pix[y-1][0]:
+            lv = labs[y-1][0]
         else:
             lastlabel += 1
-            equiv.append (lastlabel)
+            parent.append (lastlabel)
+            rank.append (0)
             lv = lastlabel
-        lab[y,x,0] = lv
+        labs[y][0] = lv
 
-    # Process the remainder of the image.
+    # Process the remainder of the image.  The neighbours of each pixel are
+    # the ones to the left (0), above (1), above-left (2) and above-right
+    # (3), the last two being used only for 8-connectivity.
     for y in range (1, ny):
-        y1 = y - 1
+        row = pix[y]
+        lrow = labs[y]
+        prow = pix[y-1]
+        lprow = labs[y-1]
         for x in range (1, nx):
-            if con8: nv = 4
-            else:    nv = 2
-            x1 = x - 1
-            x2 = x + 1
-            if x2 >= nx - 1 and con8: lastcol = True; nv -= 1
-            else: lastcol = False
-            val = im[y,x,0]
-            # Get the four neighbours' values and labels, taking care not
-            # to index off the end of the image.
-            vals[0] = im[y, x1,0]; labs[0] = lab[y, x1,0]
-            vals[1] = im[y1,x, 0]; labs[1] = lab[y1,x, 0]
+            val = row[x]
+            # Find the labels of the neighbours in the same region, taking
+            # care not to index off the end of the image.
+            matches = []
+            if val == row[x-1]: matches.append (lrow[x-1])
+            if val == prow[x]:  matches.append (lprow[x])
             if con8:
-                vals[2] = im[y1,x1,0]; labs[2] = lab[y1,x1,0]
-                if not lastcol:
-                    vals[3] = im[y1,x2,0]; labs[3] = lab[y1,x2,0]
-            inreg = False
-            for i in range (0, nv):
-                if val == vals[i]: inreg = True
-            if not inreg:
+                if val == prow[x-1]: matches.append (lprow[x-1])
+                if x + 1 < nx - 1 and val == prow[x+1]:
+                    matches.append (lprow[x+1])
+            if not matches:
                 # We're in a new region.
                 lastlabel += 1
-                equiv.append (lastlabel)
+                parent.append (lastlabel)
+                rank.append (0)
                 lv = lastlabel
             else:
-                # We must be in the same region as a neighbour.
-                matches = []
-                for i in range (0, nv):
-                    if val == vals[i]: matches.append (labs[i])
-                matches.sort ()
-                lv = int(matches[0])
+                # We must be in the same region as a neighbour, so all the
+                # matching neighbours' labels are equivalent.
+                lv = matches[0]
                 for v in matches[1:]:
-                    if equiv[v] > lv:
-                        equiv[v] = lv
-                    elif lv > equiv[v]:
-                        equiv[lv] = equiv[v]
-            lab[y,x,0] = lv
-
-    # Tidy up the equivalence table.
-    remap = list()
-    nc = -1
-    for i in range (0, len(equiv)):
-        if equiv[i] == i:
-            nc += 1
-            v = nc
-        else:
-            v = i
-            while equiv[v] != v:
-                v = equiv[v]
-            v = remap[v]
-        remap.append (v)
+                    if v != lv: _union_labels (parent, rank, lv, v)
+            lrow[x] = lv
+
+    # Tidy up the equivalence table: find the root of every label, then
+    # number the regions in order of the lowest label each one contains.
+    nl = len (parent)
+    roots = numpy.array ([_find_label (parent, v) for v in range (0, nl)])
+    rts, first = numpy.unique (roots, return_index=True)
+    number = numpy.zeros (nl, dtype=numpy.int32)
+    number[rts[numpy.argsort (first)]] = numpy.arange (len(rts))
+    remap = number[roots]
 
     # Make a second pass through the image, re-labelling the regions, then
     # return the labelled image.
-    for y in range (0, ny):
-        for x in range (0, nx):
-            lab[y,x,0] = remap[lab[y,x,0]]
+    lab[:,:,0] = remap[numpy.array (labs)]
     return lab, maxval(lab)
 
 #-------------------------------------------------------------------------------
@@ -2627,21 +2700,25 @@ def labelled_region (labim, lab, bg=0.0, fg=max_image_value):
     """
     im = image (labim)
     set (im, bg)
-    im[numpy.where (labim == lab)] = fg
+    im[labim == lab] = fg
     return im
 
 #-------------------------------------------------------------------------------
-def log1 (im):
+def log1 (im, inplace=False):
     """
     Return the result of adding unity to every pixel of `im` and taking its
     logarithm; this keeps zeros unchanged.
 
     Arguments:
-    im  image
+         im  image (modified if inplace is True)
+    inplace  if True, overwrite im with the result rather than creating a
+             new image (default: False)
 
     """
-    im = numpy.log (im + 1)
-    return im
+    if inplace:
+        numpy.log1p (im, out=im)
+        return im
+    return numpy.log1p (im)
 
 #-------------------------------------------------------------------------------
 def lut (im, table, stretch=False, limits=None):
@@ -2762,14 +2839,15 @@ def mark_features (im, locs, v=max_image_value, fac=1.0, fast=False,
     im *= scale
     fac = 1.0
     ny, nx, nc = sizes (im)
-    for y, x, s, o in locs:
-        yy = y + fac * s * math.sin (-o)
-        xx = x + fac * s * math.cos (-o)
-        if yy < 0: yy = 0
-        if yy >= ny: yy = ny - 1
-        if xx < 0: xx = 0
-        if xx >= nx: xx = nx - 1
-        draw_line (im, y, x, yy, xx, v, fast=fast)
+    # Work out the end-points of all the lines, keeping them within the
+    # image, then draw them.
+    y, x, s, o = numpy.asarray (locs, dtype=float).reshape (-1, 4).T
+    yy = numpy.maximum (y + fac * s * numpy.sin (-o), 0)
+    xx = numpy.maximum (x + fac * s * numpy.cos (-o), 0)
+    yy[yy >= ny] = ny - 1
+    xx[xx >= nx] = nx - 1
+    for i in range (0, len(y)):
+        draw_line (im, y[i], x[i], yy[i], xx[i], v, fast=fast)
     if disp: display (im)
 
 #-------------------------------------------------------------------------------
@@ -2834,7 +2912,8 @@ def mark_peaks (im, pos, v=max_image_value, disp=False, scale=1.0,
 
     Arguments:
         im  image in which the peak positions are to be marked (modified)
-       pos  list of peaks, each element itself a list of [height, y, x]
+       pos  list of peaks, each element itself a list of [height, y, x],
+            or the equivalent PeakArrays from peak_arrays()
          v  value to which peak locations will be set
             (default: max_image_value)
       disp  if True, display the marked-up image
@@ -2850,8 +2929,9 @@ def mark_peaks (im, pos, v=max_image_value, disp=False, scale=1.0,
     """
     im = reshape3 (im)
     im *= scale
-    for ht, y, x in pos:
-        mark_at_position (im, y, x, v, symbol, size)
+    pos = peak_arrays (pos)
+    for i in range (0, len(pos.h)):
+        mark_at_position (im, pos.y[i], pos.x[i], v, symbol, size)
     if disp: display (im, name=name)
 
 #-------------------------------------------------------------------------------
@@ -2977,8 +3057,12 @@ def modulus_squared (im):
     im  image for which the power spectrum is to be formed
 
     """
-    t = im * numpy.conjugate (im)
-    return t.real.copy ()
+    # Summing the squares of the real and imaginary parts avoids forming
+    # a complex temporary the size of the image.
+    ms = im.real * im.real
+    if numpy.iscomplexobj (im):
+        ms += im.imag * im.imag
+    return ms
 
 #-------------------------------------------------------------------------------
 def mono (im):
@@ -3096,7 +3180,7 @@ def oriented_bounding_box (im, disp=False, v=255):
         pts[i,0] = y[i]
 
     ca = numpy.cov (pts, y=None, rowvar=0, bias=1)
-    v, vect = numpy.linalg.eig (ca)
+    evals, vect = numpy.linalg.eig (ca)
     tvect = numpy.transpose (vect)
 
     # Use the inverse of the eigenvectors as a rotation matrix and rotate the
@@ -3124,12 +3208,10 @@ def oriented_bounding_box (im, disp=False, v=255):
     corners = numpy.dot (corners, tvect)
     centre = numpy.dot (centre, tvect)
 
-    # If required, display the result.
+    # If required, draw the box on the image and display the result.
     if disp:
-        for c in range (1, 5):
-            draw_line_fast (im, corners[c-1][0], corners[c-1][1],
-                            corners[c][0], corners[c][1], v=v)
-            display (im)
+        draw_oriented_box (im, corners[:4], v=v)
+        display (im)
     return corners[:4]
 
 #-------------------------------------------------------------------------------
@@ -3149,7 +3231,8 @@ def pca_channels (im):
     im = reshape3 (im)
     ny, nx, nc = sizes (im)
     covmat, aves = covariance_matrix (im)
-    vals, vecs = numpy.linalg.eigh (covmat)
+    if nc == 3: vals, vecs = _eigh3 (covmat)
+    else:       vals, vecs = numpy.linalg.eigh (covmat)
     perm = numpy.argsort(-vals)  # sort in descending order of eigenvalue
     vecs = vecs[:,perm].T        # transpose to give the kernel
     vals = vals[perm]
@@ -3160,7 +3243,7 @@ def pca_channels (im):
 def pca_channels_project (im, vecs, aves):
     """
     Project the image im using PCA eigenvectors vecs and channel means
-    aves, both of which are produced by EVE's routine pca.
+    aves, both of which are produced by EVE's routine pca, and return it.
 
     Arguments:
       im  image for which the PCA is to be calculated (modified)
@@ -3169,14 +3252,14 @@ def pca_channels_project (im, vecs, aves):
 
     """
     im = reshape3 (im)
-    ny, nx, nc = sizes (im)
-    for y in range (0, ny):
-        for x in range (0, nx):
-            v = im[y,x,:] - aves
-            im[y,x,:] = numpy.dot (vecs, v)
+    # Project every pixel's vector of channel values in a single contraction
+    # rather than pixel by pixel.
+    im[:,:,:] = numpy.einsum ('ij,yxj->yxi', vecs, im - aves,
+                              optimize='greedy')
+    return im
 
 #-------------------------------------------------------------------------------
-def pca_decompose (data, turk_pentland=None):
+def pca_decompose (data, turk_pentland=None, k=None, dtype=None):
     """
     Perform a principal component analysis a set of data, returning the
     eigenvalues, kernel (eigenvectors) and means.
@@ -3186,34 +3269,55 @@ def pca_decompose (data, turk_pentland=None):
     equivalent samples from a series of images (i.e., the same pixel in
     each image).
 
+    Unless only some of the eigenvalues are wanted or the style of
+    decomposition is specified, it is performed by a singular value
+    decomposition of the data themselves, which avoids forming the
+    covariance matrix.
+
     Arguments:
              data  data to be decomposed
     turk_pentland  if True, eigenfaces-style decomposition is used
                    if False, conventional decomposition is performed
                    if unset, eigenfaces-style is done if the first
                    dimension is less than or equal to the second
+                k  if set, only the k largest eigenvalues and their
+                   eigenvectors are calculated (default: None)
+            dtype  if set, the data are converted to this type (e.g.,
+                   numpy.float32) before being decomposed (default: None)
 
     """
+    import scipy.linalg
+
     # Mean-zero the data.
+    if not dtype is None: data = data.astype (dtype, copy=False)
     nims, nvals = data.shape
     aves = data.mean (axis=0)
     data -= aves
-    # Do the decomposition.
+    # Do the decomposition.  When the caller has left the choice of method
+    # to us, the right singular vectors of the data are the eigenvectors of
+    # the covariance matrix and the squares of the singular values are its
+    # eigenvalues (times nvals), already in decreasing order; there are as
+    # many of them as the smaller dimension, just as the automatic choice
+    # below would give.
+    if k is None and turk_pentland is None:
+        u, sv, evecs = scipy.linalg.svd (data, full_matrices=False,
+                                         lapack_driver='gesdd')
+        evals = sv**2 / nvals
+        return evals, evecs, aves
     if turk_pentland is None: turk_pentland = nims <= nvals
     if turk_pentland:
         # Using the `trick' due to Turk and Pentland.
         covmat = numpy.dot (data, data.T) / nvals
         ctrace = covmat.trace()
-        evals, evecs = numpy.linalg.eigh (covmat)
+        evals, evecs = _eigh_largest (covmat, k)
         evecs = numpy.dot (data.T, evecs)
         # We need to normalise the eigenvectors.
-        for i in range (0, nims):
-            evecs[:,i] /= numpy.linalg.norm (evecs[:,i])
+        evecs /= numpy.linalg.norm (evecs, axis=0, keepdims=True)
     else:
         # Straightforward (as in my PhD).
         covmat = numpy.dot (data.T, data) / nvals
         ctrace = covmat.trace()
-        evals, evecs = numpy.linalg.eigh (covmat)
+        evals, evecs = _eigh_largest (covmat, k)
 
     # Sort the eigenvalues and eigenvectors into decreasing magnitude
     # of eigenvalue.
@@ -3223,7 +3327,7 @@ def pca_decompose (data, turk_pentland=None):
     return evals, evecs, aves
 
 #-------------------------------------------------------------------------------
-def pca_images (imageset, turk_pentland=None):
+def pca_images (imageset, turk_pentland=None, k=None, dtype=None):
     """
     Perform a principal component analysis of a list of images,
     returning the eigenvalues, kernel (eigenvectors) and means.  This
@@ -3235,6 +3339,10 @@ def pca_images (imageset, turk_pentland=None):
                    if False, conventional decomposition is performed
                    if unset, eigenfaces-style is done if the first
                    dimension is less than or equal to the second
+                k  if set, only the k largest eigenvalues and their
+                   eigenvectors are calculated (default: None)
+            dtype  if set, the data are converted to this type (e.g.,
+                   numpy.float32) before being decomposed (default: None)
 
     """
     # Get the imge dimensions and create an array to hold all the data in a
@@ -3247,29 +3355,41 @@ def pca_images (imageset, turk_pentland=None):
     data = numpy.zeros ((nims, nvals))
 
     # Fill the data array, converting to monochrome and re-sizing if required.
+    # Re-sized images all go into the same buffer.
+    rsim = image ((ny, nx, 1))
     for i in range (0, nims):
         im = reshape3 (imageset[i])
         imy, imx, imc = sizes (im)
         if imc != 1: im = mono (im)
-        if imy != ny or imx != nx: im = resize (im, ny, nx, 2)
+        if imy != ny or imx != nx: im = resize (im, ny, nx, 2, out=rsim)
         data[i,:] = im.reshape (nvals)
 
     # Decompose the data and return the result.
-    return pca_decompose (data, turk_pentland)
+    return pca_decompose (data, turk_pentland, k, dtype)
 
 #-------------------------------------------------------------------------------
 def pca_project (im, kernel, aves):
     """
     Project im into the principal components defined by kernel and aves,
-    returning the vector of coefficients that describe im.
+    returning the vector of coefficients that describe im.  The projection
+    of aves is remembered for as long as the same kernel and aves are used,
+    so they should not be modified between calls.
 
     Arguments:
         im  image to be projected onto the principal components
     kernel  the PCA kernel returned by eve.pca_images
       aves  the PVA means returned by eve.pca_images
     """
-    p = numpy.dot (im.reshape (1, -1) - aves, kernel.T)
-    return p[0]
+    global _pca_offset
+
+    # Rather than subtracting the means from a copy of the image, subtract
+    # their projection from that of the image.
+    if _pca_offset is None or _pca_offset[0] is not kernel \
+       or _pca_offset[1] is not aves:
+        _pca_offset = (kernel, aves, numpy.dot (kernel, aves))
+    p = numpy.dot (kernel, im.ravel ())
+    p -= _pca_offset[2]
+    return p
 
 #-------------------------------------------------------------------------------
 def pca_reconstruct (vals, kernel, aves):
@@ -3287,6 +3407,21 @@ def pca_reconstruct (vals, kernel, aves):
     """
     return numpy.dot (vals, kernel) + aves
 
+#-------------------------------------------------------------------------------
+def peak_arrays (peaks):
+    """
+    Return a list of peaks, such as that returned by find_peaks(), as a
+    PeakArrays named tuple of three parallel numpy arrays: the heights
+    `h` and the y- and x-positions `y` and `x`.  If `peaks` is already
+    a PeakArrays, it is returned unchanged.
+
+    Arguments:
+    peaks  list of peaks, each element itself a list of [height, y, x]
+    """
+    if isinstance (peaks, PeakArrays): return peaks
+    p = numpy.array (peaks, dtype=numpy.float64).reshape (-1, 3)
+    return PeakArrays (p[:,0], p[:,1].astype (int), p[:,2].astype (int))
+
 #-------------------------------------------------------------------------------
 def perimeter (im, size=3, plus=False):
     """
@@ -3296,20 +3431,33 @@ def perimeter (im, size=3, plus=False):
 
     Arguments:
       im  image for which the perimeter is to be found (modified)
-      mask  size of the mask used in the shrink (default: 3)
-      plus  if True, use a +-shaped mask (default: False)
+    size  size of the mask used in the shrink (default: 3)
+    plus  if True, use a +-shaped mask (default: False)
 
     """
-    mask = image ((size,size,1))
+    import scipy.ndimage
+
+    # Work out which pixels around each one take part in the shrink.
     if plus:
         n2 = size // 2
-        draw_line (mask, 0, n2, size, n2, v=1)
-        draw_line (mask, n2, 0, n2, size, v=1)
+        footprint = numpy.zeros ((size, size), dtype=bool)
+        footprint[:,n2] = footprint[n2,:] = True
     else:
-        set (mask, 1.0)
+        footprint = numpy.ones ((size, size), dtype=bool)
 
-    sh = shrink (im, mask)
-    im -= sh
+    # Like shrink, only the first channel is processed and the image is
+    # treated as wrapping around at its edges.  The pixels under the zeros of
+    # a +-shaped mask take part in shrink's minimum with the value zero,
+    # which matters only if the image has negative values; in that case we
+    # have to shrink the image the long way.
+    im = reshape3 (im)
+    if plus and im.min () < 0:
+        mask = image ((size, size, 1))
+        mask[:,:,0] = footprint
+        im -= shrink (im, mask)
+        return
+    im[:,:,0] -= scipy.ndimage.grey_erosion (im[:,:,0], footprint=footprint,
+                                             mode='wrap')
 
 #-------------------------------------------------------------------------------
 def pico (im, transform, fail=0, maxerr=10):
@@ -3435,6 +3583,39 @@ def pico (im, transform, fail=0, maxerr=10):
     R = math.sqrt ((max (yc, xc) + 1)**2)
     junk, hist = histogram (im, bins=Z+1, limits=[0, Z])
 
+    # The polar coordinates r and a (in degrees) of every pixel depend only
+    # on its position, so they are calculated for the whole image at once;
+    # the angles are needed only if the transform mentions a.
+    yv, xv = numpy.mgrid[0:ny,0:nx]
+    rv = numpy.sqrt ((yv - yc)**2 + (xv - xc)**2)
+    if re.search (r"\ba\b", transform):
+        av = numpy.arctan2 (yv - yc, xv - xc) * 180 / math.pi
+    else:
+        av = None
+
+    # Most transforms apply the same expression to every pixel, so we first
+    # try evaluating the right-hand side just once, with y, x, r and a
+    # holding the values for all pixels.  If that isn't possible (the
+    # transform uses a conditional or refers to pixels outside the image,
+    # for example), we fall back to evaluating it pixel by pixel.
+    expr = _pico_expression (transform)
+    if not expr is None:
+        names = {"im": im, "new": new, "y": yv, "x": xv, "r": rv, "a": av,
+                 "ny": ny, "nx": nx, "nc": nc, "yc": yc, "xc": xc,
+                 "Y": Y, "X": X, "Z": Z, "L": L, "H": H, "R": R, "hist": hist,
+                 "xcart": lambda r, a: (r * numpy.cos (a * math.pi / 180)
+                                        + 0.5).astype (int) + xc,
+                 "ycart": lambda r, a: (r * numpy.sin (a * math.pi / 180)
+                                        + 0.5).astype (int) + yc}
+        try:
+            with numpy.errstate (all="raise", under="ignore"):
+                v = numpy.asarray (eval (expr, globals (), names))
+            if v.shape == (ny, nx): v = v.reshape (ny, nx, 1)
+            new[:,:,:] = numpy.broadcast_to (v, new.shape)
+            return new
+        except Exception:
+            pass
+
     # Routines to convert back from polar to Cartesian.
     def xcart (r, a):
         return int (r * math.cos (a * math.pi / 180) + 0.5) + xc
@@ -3442,15 +3623,32 @@ def pico (im, transform, fail=0, maxerr=10):
     def ycart (r, a):
         return int (r * math.sin (a * math.pi / 180) + 0.5) + yc
 
+    # Compile the transform just once rather than at every pixel, and set up
+    # the names it may use; y, x, r and a are updated for each pixel.  A
+    # transform that fails to compile is left as a string, so the error is
+    # reported for each pixel as before.
+    try:
+        code = compile (transform, "<pico>", "exec")
+    except SyntaxError:
+        code = transform
+    names = {"im": im, "new": new, "ny": ny, "nx": nx, "nc": nc,
+             "yc": yc, "xc": xc, "Y": Y, "X": X, "Z": Z, "L": L, "H": H,
+             "R": R, "hist": hist, "xcart": xcart, "ycart": ycart,
+             "fail": fail}
+
     # Cycle over the pixels of im, evaluating the expression for each pixel
     # and handling any places where the expression fails.
     nerrs = 0
+    rv = rv.tolist ()
+    if av is not None: av = av.tolist ()
     for y in range (0, ny):
         for x in range (0, nx):
-            r = math.sqrt ((y - yc)**2 + (x - xc)**2)
-            a = math.atan2 (y - yc, x - xc) * 180 / math.pi  # in degrees
+            names["y"] = y
+            names["x"] = x
+            names["r"] = rv[y][x]
+            if av is not None: names["a"] = av[y][x]
             try:
-                exec (transform)
+                exec (code, globals (), names)
             except Exception as e:
                 if nerrs < maxerr:
                     print (e, file=sys.stderr)
@@ -3504,7 +3702,9 @@ def print_positions (pos, format="%4d %4d", intro=None, fd=sys.stdout):
 def profile (im, y0, x0, y1, x1, disp=False):
     """
     Extract the image values on a straight line from (y0,x0) to (y1,x1),
-    optionally displaying the result.
+    optionally displaying the result.  The values are interpolated
+    bilinearly at one point per pixel along the longer axis of the line,
+    and the positions along that axis are returned with the profile.
 
     Arguments:
       im  image from which the profile is desired
@@ -3514,6 +3714,8 @@ def profile (im, y0, x0, y1, x1, disp=False):
       x1  x-value (column) of the end of the line
     disp  if set, display the profile on the image (default: False)
     """
+    import scipy.ndimage
+
     im = reshape3 (im)
     ny, nx, nc = sizes (im)
     y0 = int (y0)
@@ -3525,50 +3727,25 @@ def profile (im, y0, x0, y1, x1, disp=False):
     if disp:
         sketch = eve.copy (im)
 
-    # The basis of the routine is the same code as draw_line_fast.
-    steep = True if abs(y1 - y0) > abs(x1 - x0) else False
-    if steep:
-        y0, x0 = x0, y0
-        y1, x1 = x1, y1
-    if x0 > x1:
-        x1, x0 = x0, x1
-        y1, y0 = y0, y1
-    dx = x1 - x0 + 0.0
-    dy = abs(y1 - y0)
-    e = 0.0
-    if dx == 0.0:
-        de = 1.0e30
-    else:
-        de = dy / dx
-    y = y0
-    if y0 < y1:
-        ystep =  1
+    # Sample the image at equally-spaced points along the line, one for each
+    # pixel along its longer axis and working in the direction in which that
+    # axis increases.  Values between pixels are interpolated bilinearly and
+    # points outside the image are zero.
+    if abs(y1 - y0) > abs(x1 - x0):
+        if y0 > y1:
+            y0, x0, y1, x1 = y1, x1, y0, x0
+        lo, hi = y0, y1
     else:
-        ystep = -1
-    np = x1 - x0 + 1
-
-    npts = x1 - x0 + 1
-    xvals = numpy.ndarray (npts)
-    for c in range (0, npts):
-        xvals[c] = x0 + c
+        if x0 > x1:
+            y0, x0, y1, x1 = y1, x1, y0, x0
+        lo, hi = x0, x1
+    npts = hi - lo + 1
+    xvals = numpy.arange (lo, hi + 1, dtype=float)
+    coords = [numpy.linspace (y0, y1, npts), numpy.linspace (x0, x1, npts)]
     profile = numpy.ndarray ((nc, npts))
-    ip = 0
-    for x in range (x0,x1+1):
-        v = None
-        if steep:
-            if x >= 0 and x < ny and y >= 0 and y < nx:
-                v = im[x,y,:]
-        else:
-            if x >= 0 and x < nx and y >= 0 and y < ny:
-                v = im[y,x,:]
-        if v is not None:
-            for c in range (0, nc):
-                profile[c,ip] = v[c]
-            ip += 1
-        e += de
-        if e >= 0.5:
-            y += ystep
-            e -= 1.0
+    for c in range (0, nc):
+        profile[c,:] = scipy.ndimage.map_coordinates (im[:,:,c], coords,
+                                                      order=1, mode='constant')
 
     # Return the result.
     return xvals, profile
@@ -3583,7 +3760,8 @@ def ramp (im):
     """
     im = reshape3 (im)
     ny, nx, nc = sizes (im)
-    im[:,:,:] = numpy.fromfunction (lambda i, j, k: i + j + k, ((ny, nx, nc)))
+    im[:,:,:] = numpy.arange (ny)[:,None,None] + numpy.arange (nx)[None,:,None] \
+                + numpy.arange (nc)[None,None,:]
 
 #-------------------------------------------------------------------------------
 def read_pnm (fn):
@@ -3626,19 +3804,13 @@ def read_pnm (fn):
         nc = 1
         # Create and fill the image.
         im = image ((ny, nx, nc))
-        y = 0
-        x = 0
         # Unpack the image.  Spaces between the individual pixels are optional
-        # so we walk along the tokens we have cut from the input, setting a
-        # pixel for each character.  We should strictly check that ch below is
-        # '0' or '1'...
-        for t in tokens[3:]:
-            for ch in t:
-                im[y,x,0] = 0 if ch == '0' else 1
-                x += 1
-                if x >= nx:
-                    x = 0
-                    y += 1
+        # so we join up the tokens we have cut from the input and set a pixel
+        # for each character.  We should strictly check that each character
+        # is '0' or '1'...
+        chars = numpy.frombuffer ("".join (tokens[3:]).encode ("ascii"),
+                                  dtype=numpy.uint8)[:ny*nx]
+        im.reshape (-1)[:len(chars)] = (chars != ord ("0"))
 
     elif id == "P2" or id == "P3":
         # Textual grey-scale or colour image.  Set the number of channels and
@@ -3653,12 +3825,7 @@ def read_pnm (fn):
                               % (len (tokens), ny*nx*nc+4))
         # Create and fill the image.
         im = image ((ny, nx, nc))
-        it = 4
-        for y in range (0, ny):
-            for x in range (0, nx):
-                for c in range (0, nc):
-                    im[y,x,c] = int (tokens[it])
-                    it += 1
+        im[:,:,:] = numpy.array (tokens[4:], dtype=int).reshape (ny, nx, nc)
 
     elif id == "P4":
         # Binary bitmap.  We start by parsing the header.
@@ -3667,20 +3834,12 @@ def read_pnm (fn):
         ny = int (header[2])
         nx = int (header[1])
         im = image ((ny, nx, 1))
-        # Copy across the content, one bit at a time.
-        y = 0
-        x = 0
-        for byte in content[ch:]:
-            for bitpos in range (0, 8):
-                if bitpos >= nx: break
-                bitpos = 7 - bitpos
-                bit = 1 << bitpos
-                v = 0 if (byte & bit) == 0 else 1
-                im[y,x,0] = v
-                x += 1
-                if x >= nx:
-                    y += 1
-                    x = 0
+        # Copy across the content.  Each line occupies a whole number of
+        # bytes, the most significant bit of each byte coming first.
+        nb = (nx + 7) // 8
+        data = numpy.frombuffer (content, dtype=numpy.uint8, count=ny*nb,
+                                 offset=ch)
+        im[:,:,0] = numpy.unpackbits (data.reshape (ny, nb), axis=1)[:,:nx]
 
     elif id == "P5" or id == "P6":
         # Binary grey-scale or colour image.  Set the number of channels and
@@ -3692,11 +3851,9 @@ def read_pnm (fn):
         nx = int (header[1])
         im = image ((ny, nx, nc))
         # Copy across the content.
-        for y in range (0, ny):
-            for x in range (0, nx):
-                for c in range (0, nc):
-                    im[y,x,c] = content[ch]
-                    ch += 1
+        im[:,:,:] = numpy.frombuffer (content, dtype=numpy.uint8,
+                                      count=ny*nx*nc,
+                                      offset=ch).reshape (ny, nx, nc)
     else:
         raise ValueError ("First two bytes of PBMPLUS image file are '%s'!" \
                           % str (content))
@@ -3718,14 +3875,11 @@ def reduce (im, blocksize):
     nny = ny // blocksize
     nnx = nx // blocksize
     nim = image ((nny, nnx, nc))
-    for y in range (0, nny):
-        ylo = y * blocksize
-        yhi = ylo + blocksize
-        for x in range (0, nnx):
-            xlo = x * blocksize
-            xhi = xlo + blocksize
-            for c in range (0, nc):
-                nim[y,x,c] = im[ylo:yhi,xlo:xhi,c].mean()
+    # Split the part of the image that is a whole number of blocks into
+    # blocks, then average over the two within-block axes.
+    blocks = im[:nny*blocksize,:nnx*blocksize,:].reshape (nny, blocksize,
+                                                          nnx, blocksize, nc)
+    nim[:,:,:] = blocks.mean (axis=(1, 3))
     return nim
 
 #-------------------------------------------------------------------------------
@@ -3737,13 +3891,7 @@ def reflect_horizontally (im):
     im  image to be reflected (modified)
     """
     im = reshape3 (im)
-    ny, nx, nc = sizes (im)
-    nx2 = nx // 2
-    for y in range (0, ny):
-        for x in range (0, nx2):
-            t = im[y,x,:].copy()
-            im[y,x,:] = im[y,nx-x-1,:].copy()
-            im[y,nx-x-1,:] = t
+    im[:,:,:] = im[:,::-1,:].copy ()
 
 #-------------------------------------------------------------------------------
 def reflect_vertically (im):
@@ -3754,13 +3902,7 @@ def reflect_vertically (im):
     im  image to be reflected (modified)
     """
     im = reshape3 (im)
-    ny, nx, nc = sizes (im)
-    ny2 = ny // 2
-    for y in range (0, ny2):
-        for x in range (0, nx):
-            t = im[y,x,:].copy()
-            im[y,x,:] = im[ny-y-1,x,:].copy()
-            im[ny-y-1,x,:] = t
+    im[:,:,:] = im[::-1,:,:].copy ()
 
 #-------------------------------------------------------------------------------
 def region (im, ylo, yhi, xlo, xhi):
@@ -3805,12 +3947,12 @@ def reshape3 (im):
        im  image that may need to be re-shaped
 
     """
-    shape = im.shape
-    if len (shape) == 2: im = im.reshape (shape[0], shape[1], 1)
+    if im.ndim == 3: return im
+    if im.ndim == 2: im = im.reshape (im.shape[0], im.shape[1], 1)
     return im
 
 #-------------------------------------------------------------------------------
-def resize (im, nny, nnx, order=1):
+def resize (im, nny, nnx, order=1, out=None):
     """
     Return im, re-sized to be of size (nny, nnx) by interpolation.
 
@@ -3819,17 +3961,22 @@ def resize (im, nny, nnx, order=1):
       nny  number of rows in the re-sized image
       nnx  number of columns in the re-sized image
     order  order of interpolating function (default: 1)
+      out  if supplied, an image of size (nny, nnx) with as many channels
+           as im into which the result is written (default: None)
     """
     # The following is adapted from an example in the scipy cookbook.
     import scipy.ndimage
     im = reshape3 (im)
     ny, nx, nc = sizes (im)
     yl, xl = numpy.mgrid[0:ny-1:nny*1j,0:nx-1:nnx*1j]
-    coords = scipy.array ([yl, xl])
-    result = image ((nny, nnx, nc))
+    coords = numpy.array ([yl, xl])
+    if out is None:
+        result = image ((nny, nnx, nc))
+    else:
+        result = reshape3 (out)
     for c in range (0, nc):
-        result[:,:,c] = scipy.ndimage.map_coordinates (im[:,:,c], coords,
-                                                       order=order)
+        scipy.ndimage.map_coordinates (im[:,:,c], coords, order=order,
+                                       output=result[:,:,c])
     return result
 
 #-------------------------------------------------------------------------------
@@ -3870,29 +4017,51 @@ def rgb_to_hsv (im):
     g = im[:,:,1]
     b = im[:,:,2]
 
-    maxc = numpy.maximum (r, numpy.maximum(g, b))
-    minc = numpy.minimum (r, numpy.minimum(g, b))
-    v = maxc
-    minc_eq_maxc = numpy.equal(minc,maxc)
-
-    # Compute the difference, but reset zeros to ones to avoid divide
-    # by zeros later.
-    ones = numpy.ones ((r.shape[0], r.shape[1]))
-    maxc_minus_minc = numpy.choose (minc_eq_maxc, (maxc-minc,ones))
-    s = (maxc - minc) / numpy.maximum (ones, maxc)
-    rc = (maxc - r) / maxc_minus_minc
-    gc = (maxc - g) / maxc_minus_minc
-    bc = (maxc - b) / maxc_minus_minc
-    maxc_is_r = numpy.equal (maxc,r)
-    maxc_is_g = numpy.equal (maxc,g)
-    maxc_is_b = numpy.equal (maxc,b)
-    h = numpy.zeros ((r.shape[0], r.shape[1]))
-    h = numpy.choose (maxc_is_b, (h, 4.0 + gc - rc))
-    h = numpy.choose (maxc_is_g, (h, 2.0 + rc - bc))
-    h = numpy.choose (maxc_is_r, (h, bc - gc))
-    im[:,:,0] = numpy.mod (h/6.0, 1.0) * 360.0
-    im[:,:,1] = s * 100.0   # to be a percentage
-    im[:,:,2] = v * 100.0 / max_image_value # to be a percentage
+    # The full-image arrays are re-used as far as possible, since the
+    # routine is limited by memory traffic rather than arithmetic.  The
+    # differences between components are formed in the type of the image,
+    # where they are exact for integers, and everything after that is done
+    # in double precision, so images of any type can be converted.
+    ft = numpy.result_type (im.dtype, numpy.float64)
+    maxc = numpy.maximum (r, g)
+    numpy.maximum (maxc, b, out=maxc)
+    delta = numpy.minimum (r, g)
+    numpy.minimum (delta, b, out=delta)
+    numpy.subtract (maxc, delta, out=delta)
+    delta = delta.astype (ft, copy=False)
+    s = numpy.maximum (maxc, 1.0, dtype=ft)
+    numpy.divide (delta, s, out=s)
+
+    # Work out how far each component is below the maximum relative to the
+    # spread of the components.  Where the components are all equal, the
+    # differences are already zero and are left alone to avoid dividing by
+    # zero.
+    nz = delta != 0
+    rc = numpy.subtract (maxc, r).astype (ft, copy=False)
+    gc = numpy.subtract (maxc, g).astype (ft, copy=False)
+    bc = numpy.subtract (maxc, b).astype (ft, copy=False)
+    numpy.divide (rc, delta, out=rc, where=nz)
+    numpy.divide (gc, delta, out=gc, where=nz)
+    numpy.divide (bc, delta, out=bc, where=nz)
+
+    # The hue depends on which component is the largest, red taking
+    # precedence over green and green over blue.
+    h = numpy.add (gc, 4.0)
+    h -= rc
+    rc += 2.0
+    rc -= bc
+    numpy.subtract (bc, gc, out=bc)
+    numpy.copyto (h, rc, where=(maxc == g))
+    numpy.copyto (h, bc, where=(maxc == r))
+    h /= 6.0
+    numpy.mod (h, 1.0, out=h)
+    h *= 360.0
+    s *= 100.0              # to be a percentage
+    v = numpy.multiply (maxc, 100.0)
+    v /= max_image_value    # to be a percentage
+    im[:,:,0] = h
+    im[:,:,1] = s
+    im[:,:,2] = v
 
 #-------------------------------------------------------------------------------
 def rgb_to_mono (im):
@@ -3909,12 +4078,9 @@ def rgb_to_mono (im):
 
     """
     im = reshape3 (im)
-    r = im[:,:,0]
-    g = im[:,:,1]
-    b = im[:,:,2]
     ny, nx, nc = sizes (im)
     lum = image ((ny, nx, 1))
-    lum[:,:,0] = 0.299*r + 0.587*g + 0.114*b
+    lum[:,:,0] = numpy.einsum ('j,yxj->yx', [0.299, 0.587, 0.114], im[:,:,0:3])
     return lum
 
 #-------------------------------------------------------------------------------
@@ -3932,42 +4098,49 @@ def rgb_to_yiq (im):
 
     """
     im = reshape3 (im)
-    r = im[:,:,0]
-    g = im[:,:,1]
-    b = im[:,:,2]
-    im[:,:,0] = 0.299*r + 0.587*g + 0.114*b
-    im[:,:,1] = 0.596*r - 0.275*g - 0.321*b
-    im[:,:,2] = 0.212*r - 0.523*g + 0.311*b
+    yiq = numpy.array ([[0.299,  0.587,  0.114],
+                        [0.596, -0.275, -0.321],
+                        [0.212, -0.523,  0.311]])
+    im[:,:,0:3] = numpy.einsum ('ij,yxj->yxi', yiq, im[:,:,0:3])
 
 #-------------------------------------------------------------------------------
-def rotate90acw (im):
+def rotate90acw (im, copy=True):
     """
     Return a copy of `im` rotated around its centre by 90 degrees anticlockwise.
 
     Arguments:
       im: image to be rotated
+    copy: if False, return a view of `im` rather than a contiguous copy
+          (default: True)
     """
-    return numpy.rot90 (im, 1)
+    rim = numpy.rot90 (im, 1)
+    return numpy.ascontiguousarray (rim) if copy else rim
 
 #-------------------------------------------------------------------------------
-def rotate90cw (im):
+def rotate90cw (im, copy=True):
     """
     Return a copy of `im` rotated around its centre by 90 degrees clockwise.
 
     Arguments:
       im: image to be rotated
+    copy: if False, return a view of `im` rather than a contiguous copy
+          (default: True)
     """
-    return numpy.rot90 (im, 3)
+    rim = numpy.rot90 (im, 3)
+    return numpy.ascontiguousarray (rim) if copy else rim
 
 #-------------------------------------------------------------------------------
-def rotate180 (im):
+def rotate180 (im, copy=True):
     """
     Return a copy of `im` rotated around its centre by 180 degrees.
 
     Arguments:
       im: image to be rotated
+    copy: if False, return a view of `im` rather than a contiguous copy
+          (default: True)
     """
-    return numpy.rot90 (im, 2)
+    rim = numpy.rot90 (im, 2)
+    return numpy.ascontiguousarray (rim) if copy else rim
 
 #-------------------------------------------------------------------------------
 def set_mean_sd (im, newmean, newsd):
@@ -3981,10 +4154,16 @@ def set_mean_sd (im, newmean, newsd):
     """
     oldmean = mean (im)
     oldsd = sd (im)
-    im -= oldmean
-    im /= oldsd
-    im *= newsd
-    im += newmean
+    # An 8-bit image has only 256 possible values, so we rescale those and
+    # look each pixel up, rounding and clipping to the range of the type.
+    if im.dtype == numpy.uint8:
+        lut = (numpy.arange (256) - oldmean) / oldsd * newsd + newmean
+        lut = numpy.clip (numpy.rint (lut), 0, 255).astype (numpy.uint8)
+        im[...] = lut[im]
+    else:
+        im -= oldmean
+        im *= newsd / oldsd
+        im += newmean
 
 #-------------------------------------------------------------------------------
 def set_to_pattern (im, yfac=100, xfac=10, cfac=1):
@@ -3999,12 +4178,8 @@ def set_to_pattern (im, yfac=100, xfac=10, cfac=1):
        cfac  increment to make for each channel of a pixel (default: 1)
     """
     ny, nx, nc = sizes (im)
-    for y in range (0, ny):
-        yy = yfac * y
-        for x in range (0, nx):
-            xx = xfac * x
-            for c in range (0, nc):
-                im[y,x,c] = yy + xx + cfac *c
+    y, x, c = numpy.ogrid[0:ny,0:nx,0:nc]
+    im[:,:,:] = yfac * y + xfac * x + cfac * c
 
 #-------------------------------------------------------------------------------
 def sd (im):
@@ -4041,13 +4216,20 @@ def segment_hsv (im, hlo, hhi, slo, shi, vlo, vhi, ishsv=False):
     h = hsvim[:,:,0]
     s = hsvim[:,:,1]
     v = hsvim[:,:,2]
+    # Build up the mask one comparison at a time in a pair of work arrays,
+    # rather than allocating a new array for every term.  The hue test comes
+    # first so that, when it is an `or', it too needs no further array.
+    m = numpy.empty (h.shape, dtype=bool)
+    t = numpy.empty_like (m)
     if hlo > hhi:
-        m = ((h < hlo) | (hhi < h)) & (slo < s) & (s < shi) & \
-            (vlo < v) & (v < vhi)          # we span 360 degrees
+        numpy.less (h, hlo, out=m)     # we span 360 degrees
+        m |= numpy.less (hhi, h, out=t)
     else:
-        m = ((hlo < h) & (h < hhi)) & (slo < s) & (s < shi) & \
-            (vlo < v) & (v < vhi)
-    mask[numpy.where (m)] = max_image_value
+        numpy.less (hlo, h, out=m)
+        m &= numpy.less (h, hhi, out=t)
+    for lo, hi in [(slo, s), (s, shi), (vlo, v), (v, vhi)]:
+        m &= numpy.less (lo, hi, out=t)
+    numpy.multiply (m, max_image_value, out=mask[:,:,0])
     return mask
 
 #-------------------------------------------------------------------------------
@@ -4061,27 +4243,26 @@ def select_matches (scores, locs1, locs2, max_score_factor=5, max_matches=50):
     max_score_factor  ratio of the worst match to the best (default: 5)
          max_matches  maximum number of matches to return (default: 50)
     """
-    n = len(scores)
-    matches = []
+    sc = numpy.asarray (scores)
     # If the best score is actually zero (i.e., perfect), turn off the threshold
     # by making it ludicrously big.
-    if scores[0][0] != 0.0:
-        thresh  = scores[0][0] * max_score_factor
+    if sc[0,0] != 0.0:
+        thresh  = sc[0,0] * max_score_factor
     else:
         thresh = huge
-    for i in range (0, n):
-        if scores[i][0] <= thresh:
-            i1 = scores[i][1] # first image
-            i2 = scores[i][2] # second image
-            y1 = locs1[i1,0]
-            x1 = locs1[i1,1]
-            y2 = locs2[i2,0]
-            x2 = locs2[i2,1]
-            matches.append ([y1, x1, y2, x2, i1 * i2])
-            if len (matches) >= max_matches: break
-        else:
-            break
-    return matches
+    # The scores are in ascending order, so we take those before the first
+    # one that exceeds the threshold, up to max_matches of them.
+    above = numpy.flatnonzero (~(sc[:,0] <= thresh))
+    n = above[0] if above.size > 0 else sc.shape[0]
+    n = min (n, max_matches)
+    i1 = sc[:n,1].astype (int) # first image
+    i2 = sc[:n,2].astype (int) # second image
+    # The positions are floating-point but the last element of each match
+    # stays an integer, so it is added to each row separately.
+    coords = numpy.column_stack ((locs1[i1,0], locs1[i1,1],
+                                  locs2[i2,0], locs2[i2,1]))
+    prods = (i1 * i2).tolist ()
+    return [row + [p] for row, p in zip (coords.tolist (), prods)]
 
 #-------------------------------------------------------------------------------
 def select_pixels_above (im, threshold):
@@ -4092,15 +4273,8 @@ def select_pixels_above (im, threshold):
            im  image to be examined
     threshold  threshold above which pixels are identified
     """
-    locs = []
     im = reshape3 (im)
-    ny, nx, nc = sizes (im)
-    for y in range (0, ny):
-        for x in range (0, nx):
-            for c in range (0, nc):
-                if im[y,x,c] > threshold:
-                    locs += [[y,x,c]]
-    return locs
+    return numpy.argwhere (im > threshold).tolist ()
 
 #-------------------------------------------------------------------------------
 def select_pixels_below (im, threshold):
@@ -4111,15 +4285,8 @@ def select_pixels_below (im, threshold):
            im  image to be examined
     threshold  threshold below which pixels are identified
     """
-    locs = []
     im = reshape3 (im)
-    ny, nx, nc = sizes (im)
-    for y in range (0, ny):
-        for x in range (0, nx):
-            for c in range (0, nc):
-                if im[y,x,c] < threshold:
-                    locs += [[y,x,c]]
-    return locs
+    return numpy.argwhere (im < threshold).tolist ()
 
 #-------------------------------------------------------------------------------
 def set (im, v):
@@ -4171,9 +4338,7 @@ def shift_and_wrap (im, y, x):
      y  y-shift (positive for down)
      x  x-shift (positive for right)
     """
-    res = numpy.roll (im, int (y), axis=0)
-    res = numpy.roll (res, int (x), axis=1)
-    return res
+    return numpy.roll (im, (int (y), int (x)), axis=(0, 1))
 
 #-------------------------------------------------------------------------------
 def shrink (im, mask):
@@ -4239,33 +4404,36 @@ def sift_keypoints (fn):
     Arguments:
     im  name of a file containing the SIFT keypoints
     """
-    import scipy.linalg
-    # Read in the keypoints from the file.  We read the entire file into memory,
-    # where it ends up as a list with one line of the file in each element.
-    # Each line contains exactly 132 elements which give the position and
-    # orientation of the feature and its descriptor; we split these out into
-    # the arrays called locs and descs, normalising the latter en route.  We
-    # ultimately return locs and descs.
-    fd = open (fn)
-    lines = fd.readlines()
-    fd.close()
+    # Read in the keypoints from the file.  We read the entire file into memory
+    # and convert it to numbers in one go.  Each line contains exactly 132
+    # elements which give the position and orientation of the feature and its
+    # descriptor; we split these out into the arrays called locs and descs,
+    # normalising the latter en route.  We ultimately return locs and descs.
+    # Files that have been read before and not changed since are taken from
+    # _sift_cache; copies are returned so that the cached arrays are safe.
+    key = os.path.abspath (fn)
+    mtime = os.path.getmtime (fn)
+    if key in _sift_cache and _sift_cache[key][0] == mtime:
+        _sift_cache.move_to_end (key)
+        locs, descs = _sift_cache[key][1:]
+        return locs.copy (), descs.copy ()
+    with open (fn) as fd:
+        values = numpy.array (fd.read().split(), dtype=float)
     lf = 128          # length of each descriptor
-    nf = len (lines)  # number of features
-    if nf == 0: return None, None
+    if values.size == 0: return None, None
+    values = values.reshape (-1, 4 + lf)
+    nf = values.shape[0]  # number of features
     locs = numpy.zeros ((nf, 4))
-    descs = numpy.zeros ((nf, lf))
-    for f in range (0, nf):
-        v = lines[f].split()
-        p = 0
-        # row, col, scale, orientation
-        locs[f,1] = float (v[p])
-        locs[f,0] = float (v[p+1])
-        locs[f,2] = float (v[p+2])
-        locs[f,3] = float (v[p+3])
-        p += 4
-        for i in range (0, lf):
-            descs[f,i] = float (v[p+i])
-        descs[f] = descs[f] / scipy.linalg.norm (descs[f])
+    # row, col, scale, orientation
+    locs[:,0] = values[:,1]
+    locs[:,1] = values[:,0]
+    locs[:,2:4] = values[:,2:4]
+    descs = values[:,4:].copy ()
+    descs /= numpy.linalg.norm (descs, axis=1, keepdims=True)
+    _sift_cache[key] = (mtime, locs.copy (), descs.copy ())
+    _sift_cache.move_to_end (key)
+    while len (_sift_cache) > sift_cache_size:
+        _sift_cache.popitem (last=False)
     return locs, descs
 
 #-------------------------------------------------------------------------------
@@ -4283,18 +4451,23 @@ def skeleton (im, mask, verbose=True):
     nits = 0
     ny, nx, nc = sizes (im)
     skel = image ((ny, nx, nc), type="uint8")
+    # The image for the next iteration is held in nxt, which is allocated
+    # just once: the step reads each pixel of im before overwriting it, so
+    # from the second iteration on im and nxt can be the same array.  The
+    # step works on all the arrays flattened, as a single stream each.
+    nxt = image ((ny, nx, nc), type="uint8")
+    step = _jit (_skeleton_kernel, fallback=_skeleton_step)
+    im = numpy.ascontiguousarray (im)
     while True:
         nits += 1
         if verbose: print (nits, end="\r")
         eroded = convolve (im, mask, statistic="min")
         opened = convolve (eroded, mask, statistic="max")
-        temp = (im - opened).astype ("uint8")
-        eroded = eroded.astype ("uint8")
-        skel = numpy.bitwise_or (skel, temp)
-        if eroded.sum () == 0:
+        if step (im.ravel (), opened.ravel (), eroded.ravel (), skel.ravel (),
+                 nxt.ravel ()) == 0:
             break
         else:
-            im = copy (eroded)
+            im = nxt
 
     if verbose: print ()
     return skel
@@ -4332,7 +4505,6 @@ def sobel (im):
     Arguments:
     im  image in which the edges are to be found
     """
-    import scipy
     import scipy.ndimage as ndimage
 
     # Convert the EVE-format image into one compatible with scipy, run its
@@ -4343,9 +4515,8 @@ def sobel (im):
     else:       sci_im = mono(im)[:,:,0]
     grad_x = ndimage.sobel (sci_im, 0)
     grad_y = ndimage.sobel (sci_im, 1)
-    grad_mag = scipy.sqrt (grad_x**2 + grad_y**2)
     gm = image ((ny,nx,1))
-    gm[:,:,0] = grad_mag[:,:]
+    numpy.hypot (grad_x, grad_y, out=gm[:,:,0])
     return gm
 
 #-------------------------------------------------------------------------------
@@ -4357,7 +4528,11 @@ def ssd (im1, im2):
     im1  image form which im2 is to be subtracted
     im2  image to be subtracted from im1
     """
-    return ((im1 - im2)**2).sum()
+    # For floating-point images the sum of squares is a BLAS scalar product
+    # of the difference with itself, saving a pass over the data.
+    d = (im1 - im2).ravel ()
+    if d.dtype.kind == "f": return numpy.dot (d, d)
+    return (d**2).sum()
 
 #-------------------------------------------------------------------------------
 def statistics (im, output=False, prefix="   ", fd=sys.stdout):
@@ -4375,9 +4550,9 @@ def statistics (im, output=False, prefix="   ", fd=sys.stdout):
             (default: sys.stdout)
 
     """
-    lo, hi = extrema (im)
-    ave = mean (im)
-    sdev = sd (im)
+    # All four statistics are found in a single pass through the image.
+    step = _jit (_statistics_kernel, fallback=_statistics_step)
+    lo, hi, ave, sdev = step (numpy.ravel (im))
     if output:
         print (prefix + "mean:", ave, file=fd)
         print (prefix + "s.d.:", sdev, file=fd)
@@ -4400,9 +4575,7 @@ def subsample (im, inc=2):
     ny2 = ny // inc
     nx2 = nx // inc
     im2 = image ((ny2, nx2, nc))
-    for y in range (0, ny2):
-        for x in range (0, nx2):
-            im2[y,x,:] = im[inc*y,inc*x,:]
+    im2[:,:,:] = im[0:ny2*inc:inc,0:nx2*inc:inc,:]
     return im2
 
 #-------------------------------------------------------------------------------
@@ -4458,12 +4631,9 @@ def swap_channels (im):
       im  the image whose channels are to be swapped
 
     """
-    res = im.copy ()
-    ch0 = im[:,:,0]
-    ch2 = im[:,:,2]
-    res[:,:,2] = ch0[:,:]
-    res[:,:,0] = ch2[:,:]
-    return res
+    # Any channels beyond the third (such as alpha) stay where they are.
+    order = [2, 1, 0] + list (range (3, im.shape[2]))
+    return numpy.take (im, order, axis=2)
     
 #-------------------------------------------------------------------------------
 def thong (im, scale=64.0, offset=128.0):
@@ -4488,19 +4658,12 @@ def thong (im, scale=64.0, offset=128.0):
     radsq4 = radsqd / 4.0
     fac = 2 * math.pi * 0.496
 
-    # Fill the region with the pattern.
-    for y in range (0, ny):
-        yy = (y - yc) **2
-        for x in range (0, nx):
-            rsqd = (x - xc) **2 + yy
-            if rsqd <= radsq4:
-                v = scale * math.cos (fac*rsqd/rad) + offset
-                for c in range (0, nc):
-                    im[y,x,c] = v
-            else:
-                r = math.sqrt (rsqd)
-                v = scale * math.cos (fac * (2*r - rsqd/rad - rad2)) + offset
-                im[y,x,:] = v
+    # Fill the region with the pattern, which has one form inside a circle
+    # around the centre and another outside it.
+    plane = numpy.empty ((ny, nx))
+    fill = _jit (_thong_kernel, fallback=_thong_pattern)
+    fill (plane, yc, xc, rad, rad2, radsq4, fac, scale, offset)
+    im[:,:,:] = plane[:,:,numpy.newaxis]
 
 #-------------------------------------------------------------------------------
 def transpose (im):
@@ -4511,9 +4674,7 @@ def transpose (im):
     im  image to be transposed
     """
     im = reshape3 (im)
-    ny, nx, nc = sizes (im)
-    tr = image ((nx, ny, nc))
-    return numpy.transpose (im, axes=(1, 0, 2))
+    return numpy.ascontiguousarray (numpy.transpose (im, axes=(1, 0, 2)))
 
 #-------------------------------------------------------------------------------
 def variance (im):
@@ -4628,15 +4789,10 @@ def write (xim, fn, bgr=False):
         ".pnm" or ".pgm" or ".ppm" for PBMPLUS format
     bgr  the channels are ordered B-G-R as in OpenCV (default: False)
     """
-    # Make sure the channels are in the right order.
-    im = xim.copy ()
-    if bgr:
-        b = xim[:,:,0]
-        g = xim[:,:,1]
-        r = xim[:,:,2]
-        im[:,:,0] = r
-        im[:,:,1] = g
-        im[:,:,2] = b
+    # Make sure the channels are in the right order.  The writing routines
+    # don't modify the image, so it is only copied when the channels have to
+    # be swapped.
+    im = swap_channels (xim) if bgr else xim
 
     # Determine the output format from the filename and invoke the appropriate
     # routine to do the saving.
@@ -4696,7 +4852,7 @@ def write_pil (im, fn, format='PNG'):
     from PIL import Image
     im = reshape3 (im)
     ny, nx, nc = sizes (im)
-    bim = im.astype ('B')
+    bim = numpy.ascontiguousarray (im, dtype=numpy.uint8)
     if nc == 3:
         pilImage = Image.fromarray (bim, 'RGB')
     elif nc == 4:
@@ -4760,13 +4916,15 @@ def write_pnm (im, fn, binary=True, stretch=False, biggreys=False):
         else:
             f = open (fn, "wb")
         # Write the header.
-        f.write ((pbmtype + "\n%d %d\n%d\n" % (nx, ny, opmax)).encode())
-        # Scale the data if necessary and write them out.
-        temp = im
-        if stretch: temp = (temp - lo) * fac
-        # Ensure the image is in C-contiguous order for easy writing.
-        temp = numpy.asarray(temp, order="C")
-        f.write (temp.astype("B"))
+        f.write (b"%s\n%d %d\n%d\n" % (pbmtype.encode (), nx, ny, opmax))
+        # Scale the data if necessary, converting them straight to bytes in
+        # C-contiguous order for easy writing, and write them out.
+        if stretch:
+            temp = numpy.empty ((ny, nx, nc), dtype=numpy.uint8)
+            numpy.multiply (im - lo, fac, out=temp, casting="unsafe")
+        else:
+            temp = numpy.ascontiguousarray (im, dtype=numpy.uint8)
+        f.write (temp)
 
     else:
         # Decide on the identifier that goes into the header.
@@ -4783,22 +4941,12 @@ def write_pnm (im, fn, binary=True, stretch=False, biggreys=False):
             f = open (fn, "w")
         # Write the header.
         f.write (pbmtype + "\n%d %d\n%d\n" % (nx, ny, opmax))
-        # Scale the data if necessary and write them out.
-        for y in range (0, ny):
-            for x in range (0, nx):
-                for c in range (0, nc):
-                    if stretch:
-                        v = (im[y,x,c] - lo) * fac
-                        if v > opmax: v = opmax
-                        if v < opmin: v = opmin
-                    else:
-                        v = im[y,x,c]
-                    if binary:
-                        byte = struct.pack ("B", v)
-                        f.write (byte)
-                    else:
-                        f.write (fmt % v)
-        f.write ("\n")
+        # Scale the data if necessary and write them out, one line of the
+        # image per line of the file.
+        temp = im
+        if stretch: temp = numpy.clip ((temp - lo) * fac, opmin, opmax)
+        numpy.savetxt (f, temp.astype (int).reshape (ny, nx*nc), fmt=fmt,
+                       delimiter="")
 
     # Close the file.
     if fn != "-": f.close ()
@@ -4815,6 +4963,176 @@ def zero (im):
 
 #-------------------------------------------------------------------------------
 # Internal routines.
+#-------------------------------------------------------------------------------
+def _eigh3 (a):
+    """
+    Internal routine used by `pca_channels` to return the eigenvalues (in
+    ascending order) and eigenvectors (as columns) of the symmetric 3 x 3
+    matrix `a`, as numpy.linalg.eigh does.  The eigenvalues are found from
+    the roots of the characteristic polynomial in closed form (O. K. Smith,
+    Comm. ACM 4(4) p. 168, 1961) and each eigenvector as the cross-product
+    of two rows of a - lambda I.  Should two eigenvalues be (nearly) equal,
+    so that an eigenvector is poorly defined, numpy.linalg.eigh is used.
+    """
+    a = numpy.asarray (a, dtype=numpy.float64)
+    p1 = a[0,1]**2 + a[0,2]**2 + a[1,2]**2
+    if p1 == 0.0:
+        # The matrix is diagonal.
+        vals = numpy.diag (a).copy ()
+        idx = numpy.argsort (vals)
+        return vals[idx], numpy.eye (3)[:,idx]
+    q = numpy.trace (a) / 3
+    p = math.sqrt (((a[0,0] - q)**2 + (a[1,1] - q)**2 + (a[2,2] - q)**2
+                    + 2 * p1) / 6)
+    b = (a - q * numpy.eye (3)) / p
+    r = min (max (numpy.linalg.det (b) / 2, -1.0), 1.0)
+    phi = math.acos (r) / 3
+    e1 = q + 2 * p * math.cos (phi)
+    e3 = q + 2 * p * math.cos (phi + 2 * math.pi / 3)
+    vals = numpy.array ([e3, 3 * q - e1 - e3, e1])
+    vecs = numpy.zeros ((3, 3))
+    for i in range (0, 3):
+        m = a - vals[i] * numpy.eye (3)
+        cands = [numpy.cross (m[0], m[1]), numpy.cross (m[0], m[2]),
+                 numpy.cross (m[1], m[2])]
+        norms = [numpy.linalg.norm (v) for v in cands]
+        best = int (numpy.argmax (norms))
+        if norms[best] <= 1.0e-8 * p * p:
+            return numpy.linalg.eigh (a)
+        vecs[:,i] = cands[best] / norms[best]
+    return vals, vecs
+
+#-------------------------------------------------------------------------------
+def _eigh_largest (covmat, k=None):
+    """
+    Internal routine used by `pca_decompose` to return the eigenvalues and
+    eigenvectors of the symmetric matrix `covmat`.  If `k` is set, only the
+    k largest of them are calculated, using the MRRR algorithm.
+    """
+    if k is None:
+        return numpy.linalg.eigh (covmat)
+    import scipy.linalg
+    n = covmat.shape[0]
+    k = min (k, n)
+    return scipy.linalg.eigh (covmat, subset_by_index=[n-k, n-1],
+                              driver='evr')
+
+#-------------------------------------------------------------------------------
+def _find_label (parent, v):
+    """
+    Internal routine used by `label_regions_slow` to return the root of the
+    set containing label `v` in the union-find forest `parent`, halving the
+    path to the root as it goes.
+    """
+    while parent[v] != v:
+        parent[v] = parent[parent[v]]
+        v = parent[v]
+    return v
+
+#-------------------------------------------------------------------------------
+def _graph_sixel (x, y, xlabel, ylabel, title, logx, logy, style):
+    """
+    Internal routine used by `graph` to plot a graph with gnuplot as sixel
+    graphics, moving to a new line afterwards.
+    """
+    graph_gnuplot (x, y, xlabel, ylabel, title, logx=logx, logy=logy,
+                   terminal="sixel", wait=False, style=style)
+    print ()
+
+#-------------------------------------------------------------------------------
+def _jit (kernel, fallback=None):
+    """
+    Internal routine that returns the routine `kernel` compiled with numba's
+    `njit` if numba is available, or otherwise `fallback` (default: `kernel`
+    itself).  numba is imported and each kernel compiled only when it is
+    first needed.
+    """
+    if not kernel in _jitted:
+        try:
+            import numba
+            _jitted[kernel] = numba.njit (cache=True) (kernel)
+        except ImportError:
+            _jitted[kernel] = kernel if fallback is None else fallback
+    return _jitted[kernel]
+
+#-------------------------------------------------------------------------------
+def _lppic_kernel (v, im, ylo, yhi, xlo, xhi, w00, w01, w10, w11):
+    """
+    Internal routine used by `lppic` to fill `v` with the sum over the
+    channels of `im` bilinearly interpolated at the output positions, the
+    rows and columns of the neighbouring pixels being in `ylo`, `yhi`,
+    `xlo` and `xhi` and the weights of the four neighbours in `w00` to
+    `w11`.  It is compiled by _jit(); _lppic_resample is used when numba
+    is not available.
+    """
+    ymax, xmax = v.shape
+    nc = im.shape[2]
+    for y in range (0, ymax):
+        y0 = ylo[y]
+        y1 = yhi[y]
+        for x in range (0, xmax):
+            x0 = xlo[x]
+            x1 = xhi[x]
+            s = w00[y,x] * im[y0,x0,0] + w01[y,x] * im[y0,x1,0] + \
+                w10[y,x] * im[y1,x0,0] + w11[y,x] * im[y1,x1,0]
+            for c in range (1, nc):
+                s = s + (w00[y,x] * im[y0,x0,c] + w01[y,x] * im[y0,x1,c] + \
+                         w10[y,x] * im[y1,x0,c] + w11[y,x] * im[y1,x1,c])
+            v[y,x] = s
+
+#-------------------------------------------------------------------------------
+def _lppic_resample (v, im, ylo, yhi, xlo, xhi, w00, w01, w10, w11):
+    """
+    Internal routine that does the same job as _lppic_kernel using
+    whole-array operations, for use when numba is not available.
+    """
+    ylo = ylo[:,numpy.newaxis]
+    yhi = yhi[:,numpy.newaxis]
+    s = 0
+    for c in range (0, im.shape[2]):
+        s = s + (w00 * im[ylo,xlo,c] + w01 * im[ylo,xhi,c] + \
+                 w10 * im[yhi,xlo,c] + w11 * im[yhi,xhi,c])
+    v[:,:] = s
+
+#-------------------------------------------------------------------------------
+def _pico_expression (transform):
+    """
+    Internal routine used by `pico` to decide whether `transform` can be
+    evaluated for all pixels at once.  This is the case if it is a single
+    assignment to new[y,x] whose right-hand side neither refers to `new`
+    nor calls anything other than xcart, ycart, abs and the functions of
+    the math module.  The right-hand side is returned compiled, ready for
+    evaluation, or None if the transform has to be applied pixel by pixel.
+    """
+    import ast
+
+    try:
+        tree = ast.parse (transform)
+    except SyntaxError:
+        return None
+    if len (tree.body) != 1 or not isinstance (tree.body[0], ast.Assign):
+        return None
+    stmt = tree.body[0]
+    if len (stmt.targets) != 1: return None
+    t = stmt.targets[0]
+    if not isinstance (t, ast.Subscript) or \
+       not isinstance (t.value, ast.Name) or t.value.id != "new" or \
+       not isinstance (t.slice, ast.Tuple) or \
+       [getattr (e, "id", None) for e in t.slice.elts] != ["y", "x"]:
+        return None
+    for node in ast.walk (stmt.value):
+        if isinstance (node, ast.Name) and node.id == "new":
+            return None
+        if isinstance (node, ast.Call):
+            f = node.func
+            if isinstance (f, ast.Name) and f.id in ["xcart", "ycart", "abs"]:
+                continue
+            if isinstance (f, ast.Attribute) and \
+               isinstance (f.value, ast.Name) and f.value.id == "math":
+                continue
+            return None
+    return compile (ast.Expression (stmt.value), "<pico>", "eval")
+
 #-------------------------------------------------------------------------------
 def _pnm_header (content, header_size):
     """
@@ -4823,26 +5141,22 @@ def _pnm_header (content, header_size):
     return the header and the next location in `content` to be read, which
     should be the image data themselves.
     """
-    # We step forward from the start of the file, ignoring comments, until
-    # we have read header_size whitespace-delimited values.  Note that the
-    # end-of-line can be any of "^M" (ASCII 13, as found on old Macs),
-    # "^J" (ASCII 10, as used under Unix) or both (as used in Windows, DOS
-    # and OpenVMS if it every reappears).
+    # We step forward from the start of the file a line at a time, ignoring
+    # comments, until we have read header_size whitespace-delimited values.
+    # Note that the end-of-line can be any of "^M" (ASCII 13, as found on old
+    # Macs), "^J" (ASCII 10, as used under Unix) or both (as used in Windows,
+    # DOS and OpenVMS if it every reappears).
+    eol = re.compile (rb"\r\n|\r|\n")
     header = []
     loc = 0
     while len (header) < header_size:
-        line = []
-        comment = False
-        while content[loc] != 13 and content[loc] != 10:
-            if content[loc] == ord ("#"):
-                comment = True
-            line += chr (content[loc])
-            loc += 1
-        if not comment:
-            line = "".join (line)
-            header.extend (line.split ())
-        if content[loc] == 10:
-            loc += 1
+        m = eol.search (content, loc)
+        if m is None:
+            raise ValueError ("PBMPLUS header is incomplete!")
+        line = content[loc:m.start()]
+        if not b"#" in line:
+            header.extend (line.decode ("latin-1").split ())
+        loc = m.end ()
 
     return header, loc
 
@@ -4870,6 +5184,121 @@ def _pnm_tokenize (content):
 
     return tokens
 
+#-------------------------------------------------------------------------------
+def _skeleton_kernel (im, opened, eroded, skel, nxt):
+    """
+    Internal routine used by `skeleton` to carry out the arithmetic of one
+    iteration in a single pass: the pixels of `im` removed by opening are
+    or-ed into `skel`, and `eroded` is stored in `nxt` as the image for the
+    next iteration.  The arrays are all one-dimensional, and `nxt` may be
+    the same array as `im`.  The sum of `nxt` is returned.  It is compiled
+    by _jit(); _skeleton_step is used when numba is not available.
+    """
+    total = 0
+    for i in range (0, im.size):
+        skel[i] |= numpy.uint8 (im[i] - opened[i])
+        v = numpy.uint8 (eroded[i])
+        nxt[i] = v
+        total += v
+    return total
+
+#-------------------------------------------------------------------------------
+def _skeleton_step (im, opened, eroded, skel, nxt):
+    """
+    Internal routine that does the same job as _skeleton_kernel using
+    whole-array operations, for use when numba is not available.
+    """
+    skel |= (im - opened).astype ("uint8")
+    nxt[:] = eroded
+    return nxt.sum ()
+
+#-------------------------------------------------------------------------------
+def _statistics_kernel (values):
+    """
+    Internal routine used by `statistics` to return the minimum, maximum,
+    mean and standard deviation of the one-dimensional array `values` in a
+    single pass, the last two being accumulated by Welford's method.  It is
+    compiled by _jit(); _statistics_step is used when numba is not
+    available.
+    """
+    n = values.size
+    lo = hi = values[0]
+    ave = 0.0
+    m2 = 0.0
+    for i in range (0, n):
+        v = values[i]
+        if v < lo: lo = v
+        if v > hi: hi = v
+        d = v - ave
+        ave += d / (i + 1)
+        m2 += d * (v - ave)
+    sdev = math.sqrt (m2 / (n - 1)) if n > 1 else math.nan
+    return lo, hi, ave, sdev
+
+#-------------------------------------------------------------------------------
+def _statistics_step (values):
+    """
+    Internal routine that does the same job as _statistics_kernel using
+    whole-array operations, for use when numba is not available.  The
+    results are Python numbers with the mean and standard deviation
+    accumulated in double precision, as the kernel returns them.
+    """
+    lo, hi = extrema (values)
+    ave = float (values.mean (dtype=numpy.float64))
+    if values.size > 1:
+        sdev = float (values.std (dtype=numpy.float64, ddof=1))
+    else:
+        sdev = math.nan
+    return lo.item (), hi.item (), ave, sdev
+
+#-------------------------------------------------------------------------------
+def _thong_kernel (plane, yc, xc, rad, rad2, radsq4, fac, scale, offset):
+    """
+    Internal routine used by `thong` to fill `plane` with the test pattern,
+    working out the form of the pattern and its value at each pixel in a
+    single pass.  It is compiled by _jit(); _thong_pattern is used when
+    numba is not available.
+    """
+    ny, nx = plane.shape
+    for y in range (0, ny):
+        yy = (y - yc) **2
+        for x in range (0, nx):
+            rsqd = (x - xc) **2 + yy
+            if rsqd <= radsq4:
+                v = fac * rsqd / rad
+            else:
+                r = math.sqrt (rsqd)
+                v = fac * (2*r - rsqd/rad - rad2)
+            plane[y,x] = scale * math.cos (v) + offset
+
+#-------------------------------------------------------------------------------
+def _thong_pattern (plane, yc, xc, rad, rad2, radsq4, fac, scale, offset):
+    """
+    Internal routine that does the same job as _thong_kernel using
+    whole-array operations, for use when numba is not available.
+    """
+    ny, nx = plane.shape
+    y, x = numpy.ogrid[0:ny,0:nx]
+    rsqd = (x - xc)**2 + (y - yc)**2
+    r = numpy.sqrt (rsqd)
+    v = numpy.where (rsqd <= radsq4, fac * rsqd / rad,
+                     fac * (2*r - rsqd/rad - rad2))
+    plane[:,:] = scale * numpy.cos (v) + offset
+
+#-------------------------------------------------------------------------------
+def _union_labels (parent, rank, a, b):
+    """
+    Internal routine used by `label_regions_slow` to merge the sets that
+    contain labels `a` and `b` in the union-find forest `parent`, attaching
+    the shallower tree (according to `rank`) beneath the deeper one.
+    """
+    a = _find_label (parent, a)
+    b = _find_label (parent, b)
+    if a == b: return
+    if rank[a] < rank[b]: a, b = b, a
+    parent[b] = a
+    if rank[a] == rank[b]: rank[a] += 1
+
 #-------------------------------------------------------------------------------
 # Graphical output routines.
 #-------------------------------------------------------------------------------
@@ -4924,7 +5353,7 @@ def display (im, stretch=False, bgr=False, name="Eve image", wait=False):
     output that is available when calling a device-specific routine.
 
     Arguments:
-         im  image to be displayed
+         im  image to be displayed, or a list of images
     stretch  if True, displayed image will be contrast-stretched
         bgr  the channels are ordered B-G-R as in OpenCV (default: False)
        name  the name given to the window
@@ -4937,19 +5366,23 @@ def display (im, stretch=False, bgr=False, name="Eve image", wait=False):
     if use_graphics is None:
         select_graphics_type ()
 
-    if use_graphics == "default":
-        display_external (im, stretch=stretch, bgr=bgr, name=name, wait=wait)
-    elif use_graphics == "sixel":
-        display_sixel (im, stretch=stretch, bgr=bgr, name=name)
-    elif use_graphics == "tty":
-        lppic (im, [" ./WX#"], width=80)
-    elif use_graphics == "lp":
-        lppic (im)
-    else:
+    if not use_graphics in display_routines:
         print ("Internal error in display ('%s')!" % use_graphics,
                file=sys.stderr)
         sys.exit (99)
 
+    # A list of images is handed to a single external program if we can,
+    # otherwise the images are displayed one after the other.
+    if isinstance (im, list):
+        if use_graphics == "default":
+            display_external_sequence (im, stretch=stretch, bgr=bgr,
+                                       name=name, wait=wait)
+        else:
+            for one in im:
+                display_routines[use_graphics] (one, stretch, bgr, name, wait)
+        return
+    display_routines[use_graphics] (im, stretch, bgr, name, wait)
+
 #-------------------------------------------------------------------------------
 def graph (x, y, xlabel, ylabel, title="", logx=False, logy=False,
            style="linespoints"):
@@ -4980,19 +5413,12 @@ Plot a graph using whatever graphics subsystem has been chosen.
     if use_graphics is None:
         select_graphics_type ()
 
-    if use_graphics == "default":
-        graph_gnuplot (x, y, xlabel, ylabel, title, logx=logx, logy=logy,
-                       style=style)
-    elif use_graphics == "sixel":
-        graph_gnuplot (x, y, xlabel, ylabel, title, logx=logx, logy=logy,
-                       terminal="sixel", wait=False, style=style)
-        print ()
-    elif use_graphics == "tty":
-        lpgraph (x, y, xlabel, ylabel, title, logx=logx, logy=logy, style=style)
-    else:
+    if not use_graphics in graph_routines:
         print ("Internal error in graph ('%s')!" % use_graphics,
                file=sys.stderr)
         sys.exit (99)
+    graph_routines[use_graphics] (x, y, xlabel, ylabel, title, logx, logy,
+                                  style)
 
 #-------------------------------------------------------------------------------
 def display_external (im, stretch=False, wait=False, bgr=False,
@@ -5010,14 +5436,18 @@ def display_external (im, stretch=False, wait=False, bgr=False,
              (default: system-dependent)
        hint  output a line saying how to close the display (default: False)
     """
-    # Make sure the channels are in the right order.
-    if bgr: im = swap_channels (im)
+    # Make sure the channels are in the right order.  For the usual three
+    # channels, a reversed view does this without copying the image; the
+    # routines that write it out copy it only if they need to.
+    if bgr:
+        if im.ndim == 3 and im.shape[2] == 3: im = im[:,:,::-1]
+        else: im = swap_channels (im)
 
     # We do different things on different operating systems.
     if systype == 'Windows':
         if stretch:
-            copy = im.copy()
-            contrast_stretch (copy)
+            copy = numpy.empty (im.shape, dtype=im.dtype)
+            contrast_stretch (im, out=copy)
         else:
             copy = im
         write_pil (copy, '', 'display')    # temporary kludge
@@ -5062,8 +5492,8 @@ def display_external (im, stretch=False, wait=False, bgr=False,
                            file=sys.stderr)
             elif systype == 'Darwin':
                 if stretch:
-                    copy = im.copy()
-                    contrast_stretch (copy)
+                    copy = numpy.empty (im.shape, dtype=im.dtype)
+                    contrast_stretch (im, out=copy)
                 else:
                     copy = im
                 handle, fn = tempfile.mkstemp (suffix='.png')
@@ -5079,8 +5509,25 @@ def display_external (im, stretch=False, wait=False, bgr=False,
                 return
             else:
                 raise ValueError ('Cannot find an image display program')
-        handle, fn = tempfile.mkstemp ()
-        write_pnm (im, fn, stretch=stretch)
+
+        # ImageMagick's display reads PNG, which is much smaller for it to
+        # read than PNM, so we use that for it if PIL is there to write it.
+        # xv and programs supplied by the caller are given PNM as always.
+        import importlib.util
+        png = program == 'display' and \
+              (im.ndim == 2 or im.shape[2] in (1, 3)) and \
+              importlib.util.find_spec ("PIL") is not None
+        if png:
+            if stretch:
+                copy = numpy.empty (im.shape)
+                contrast_stretch (im, out=copy)
+            else:
+                copy = im
+            handle, fn = tempfile.mkstemp (suffix='.png')
+            write_png (copy, fn)
+        else:
+            handle, fn = tempfile.mkstemp ()
+            write_pnm (im, fn, stretch=stretch)
         if wait:
             line = "%s %s; rm -f %s"    % (program, fn, fn)
         else:
@@ -5088,18 +5535,70 @@ def display_external (im, stretch=False, wait=False, bgr=False,
         os.system (line)
         os.close (handle)
 
+#-------------------------------------------------------------------------------
+def display_external_sequence (ims, stretch=False, wait=False, bgr=False,
+                               name="EVE images", program=None, hint=False):
+    """
+    Display a sequence of images with a single run of an external program.
+
+    All the images are written into one temporary directory, which is
+    removed when the program exits.  Where no suitable program is found
+    (or on Windows), the images are shown one at a time by
+    display_external.
+
+    Arguments:
+        ims  list of images to be displayed
+    stretch  if True, displayed images will be contrast-stretched
+       wait  when True, allow the display program to exit before returning
+        bgr  the channels are ordered B-G-R as in OpenCV (default: False)
+       name  the name given to the window
+    program  external program to be used for display, which must accept
+             several PBMPLUS files on its command line
+             (default: xv or display, if available)
+       hint  output a line saying how to close the display (default: False)
+    """
+    if program is None and systype != 'Windows':
+        if find_in_path ('xv'):
+            program = 'xv -name "' + name + '"'
+        elif find_in_path ('display'):
+            program = 'display'
+    if program is None or systype == 'Windows':
+        for im in ims:
+            display_external (im, stretch=stretch, wait=wait, bgr=bgr,
+                              name=name, hint=hint)
+        return
+
+    # Write out the images and start the program on them all.  The name of
+    # the directory is quoted for the shell in case it contains spaces.
+    tmpdir = tempfile.mkdtemp ()
+    for i, im in enumerate (ims):
+        if bgr:
+            if im.ndim == 3 and im.shape[2] == 3: im = im[:,:,::-1]
+            else: im = swap_channels (im)
+        write_pnm (im, os.path.join (tmpdir, "%05d.pnm" % i), stretch=stretch)
+    if hint:
+        print ('Type "q" in the image window to close it.', file=sys.stderr)
+    qdir = shlex.quote (tmpdir)
+    line = "%s %s/*.pnm; rm -rf %s" % (program, qdir, qdir)
+    if not wait:
+        line = "(" + line + ")&"
+    os.system (line)
+
 #-------------------------------------------------------------------------------
 def display_sixel (im, stretch=False, bgr=False, wait=True, name="Eve image",
                    levels=256):
     """Display `im` as sixels."""
-    global PROGRAMS
+    global PROGRAMS, _sixel_program
 
     print (name + ":")
-    for prog, inv in PROGRAMS["sixel display"]:
-        if find_in_path (prog):
-            display_external (im, stretch=stretch, bgr=bgr, wait=wait,
-                              program=inv % levels)
-            break
+    if _sixel_program is None:
+        for prog, inv in PROGRAMS["sixel display"]:
+            if find_in_path (prog):
+                _sixel_program = inv
+                break
+    if _sixel_program is not None:
+        display_external (im, stretch=stretch, bgr=bgr, wait=wait,
+                          program=_sixel_program % levels)
     print ()
 
 #-------------------------------------------------------------------------------
@@ -5124,11 +5623,17 @@ def graph_gnuplot (x, y, xlabel='x', ylabel='y', title=' ', xlimits=None,
             or "histogram" (default: "linespoints")
        key  if supplied, a list of the same length as the number of plots
             giving the name for each curve (default: None)
-      wait  if True, allow the user to view the plot (and optionally save
-            the data to file) before continuing (default: True)
+      wait  if True, allow the user to view the plot before continuing;
+            otherwise, the graph is drawn by a gnuplot process that is kept
+            running for the next graph until close_gnuplot is called
+            (default: True)
+  terminal  if supplied, the gnuplot terminal on which the graph is drawn
+            (default: None)
         fn  if supplied, the name of a PDF file into which the graph is
             saved (in which case, wait is set to False)
     """
+    global _gnuplot
+
     # Work out and organise what we're plotting.
     if isinstance (y, numpy.ndarray):
         shape = y.shape
@@ -5150,86 +5655,82 @@ def graph_gnuplot (x, y, xlabel='x', ylabel='y', title=' ', xlimits=None,
     else:
         x = numpy.array (x)
 
-    # Start talking to Gnuplot and tell it how we'd like the graph to appear.
-    if wait:
-        p = os.popen ("gnuplot --persist", "w")
-    else:
-        p = os.popen ("gnuplot", "w")
-    if terminal is not None:
-        print ("set term " + terminal, file=p)
-    if key is None:
-        print ("set nokey", file=p)
-    print ("set grid", file=p)
-    print ('set title "%s"' % title, file=p)
-    print ('set xlabel "%s"' % xlabel, file=p)
-    print ('set ylabel "%s"' % ylabel, file=p)
-    if xlimits: print ("set xrange [%f:%f]" % (xlimits[0], xlimits[1]), file=p)
-    if logx: print ("set log x", file=p)
-    if logy: print ("set log y", file=p)
-
+    # Build up the commands for Gnuplot, starting with where the graph is to
+    # go and how we'd like it to appear.  They are all sent to it in one go
+    # once they are complete.  A graph saved to file needs no window to be
+    # left open, and the PDF terminal supersedes any other.
+    if fn is not None: wait = False
+    cmd = ["gnuplot", "--persist"] if wait else ["gnuplot"]
+    p = io.StringIO ()
     if fn is not None:
-        print ("set term pdf", file=p)
-        print ('set output "%s"' % fn, file=p)
-        wait = False
+        p.write ('set term pdf\nset output "%s"\n' % fn)
+    elif terminal is not None:
+        p.write ("set term " + terminal + "\n")
+    if key is None:
+        p.write ("set nokey\n")
+    p.write ('set grid\nset title "%s"\nset xlabel "%s"\nset ylabel "%s"\n' %
+             (title, xlabel, ylabel))
+    if xlimits: p.write ("set xrange [%f:%f]\n" % (xlimits[0], xlimits[1]))
+    if logx: p.write ("set log x\n")
+    if logy: p.write ("set log y\n")
 
     if style == "histogram":
-        print ("set style data histogram", file=p)
-        print ("binwidth=0.9", file=p)
-        print ("set boxwidth binwidth", file=p)
-        print ("set style fill solid", file=p)
+        p.write ("set style data histogram\nbinwidth=0.9\n"
+                 "set boxwidth binwidth\nset style fill solid\n")
         extra = "with boxes"
     else:
-        print ("set style data " + style, file=p)
+        p.write ("set style data " + style + "\n")
         extra = ""
 
     # Produce the plot command.
-    text = "plot "
-    for dataset in range (0, nplots):
-        text += '"-"'
-        if not key is None:
-            text += 'title "%s" ' % key[dataset]
-        text += extra + ", "
-    print (text[:-2], file=p)
+    if key is None:
+        titles = [""] * nplots
+    else:
+        titles = ['title "%s" ' % key[dataset] for dataset in range (0, nplots)]
+    p.write ("plot " + ", ".join (['"-"' + t + extra for t in titles]) + "\n")
 
     # Output the points to plot.
     for dataset in range (0, nplots):
-        for i in range (0, npoints):
-            print (x[i], y[dataset,i], file=p)
-        print ("e", file=p)
-    p.flush () 
-
-    """
-    # Exit if the user types <EOF>; give (minimal) instructions if they type
-    # "?"; simply continue if they type <return>.  Anything else typed in
-    # response to the prompt is assumed to be a filename and we save the data
-    # that file. (And yes, that can result in silly filenames...)
-    if wait:
-        looping = True
-    else:
-        looping = False
-
-    while looping:
-        sys.stderr.write ("CR> ")
-        sys.stderr.flush()
-        fn = sys.stdin.readline()
-        if len(fn) < 1:
-            print ("Exiting...", file=sys.stderr)
-            sys.exit (1)
-        if len(fn) > 0 and fn == "?\n":
-            print ('fn to save data to "fn" else <return>', file=sys.stderr)
-            continue
-        if len(fn) > 1 and fn != "":
-            f = open (fn[:-1],"w")
-            nx = len (x)
-            for i in range (0, nx):
-                print (x[i], file=f, end=" ")
-                for dataset in range (0, nplots):
-                    print (y[dataset,i], file=f, end=" ")
-                print (file=f)
-            f.close ()
-        looping = False
-    """
-    p.close ()
+        numpy.savetxt (p, numpy.column_stack ((x, y[dataset])), fmt="%.16g")
+        p.write ("e\n")
+
+    # Start Gnuplot and send it the commands.  A graph that need not be left
+    # on the screen goes instead to the gnuplot that we keep running, saving
+    # the cost of starting a new one each time, unless it is drawn on a
+    # terminal that writes to the standard output.  That gnuplot has its
+    # settings reset and its terminal restored around each graph, and we
+    # wait for it to acknowledge the end of the graph so that any file is
+    # complete when we return.
+    if wait or (terminal is not None and fn is None):
+        gp = subprocess.Popen (cmd, stdin=subprocess.PIPE)
+        gp.communicate (p.getvalue().encode ())
+        return
+    if _gnuplot is None or _gnuplot.poll () is not None:
+        _gnuplot = subprocess.Popen (["gnuplot"], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     universal_newlines=True)
+    done = "EVE graph done"
+    _gnuplot.stdin.write ("reset\nset term push\n" + p.getvalue () +
+                          "unset output\nset term pop\n" +
+                          'set print "-"\nprint "%s"\n' % done)
+    _gnuplot.stdin.flush ()
+    while True:
+        line = _gnuplot.stdout.readline ()
+        if line == "" or line.strip () == done: break
+
+#-------------------------------------------------------------------------------
+def close_gnuplot ():
+    """
+    Close the gnuplot process kept running by graph_gnuplot, if there is one.
+    """
+    global _gnuplot
+    if _gnuplot is not None:
+        _gnuplot.communicate ()
+        _gnuplot = None
+
+# Make sure the kept gnuplot process and its pipes are shut down when the
+# interpreter exits, even if the caller never calls close_gnuplot.
+atexit.register (close_gnuplot)
 
 #-------------------------------------------------------------------------------
 def graph_matplotlib (x, y, xlabel='x', ylabel='y', title=' ', logx=False,
@@ -5289,16 +5790,21 @@ def graph_matplotlib (x, y, xlabel='x', ylabel='y', title=' ', logx=False,
     else:
         ls = "-o"
 
-    # Plot the data.
-    for dataset in range (0, nplots):
-        if key is not None:
-            lab = key[dataset]
-        else:
-            lab = None
-        if style == "histogram":
+    # Plot the data.  Lines are all drawn by a single call, one per column
+    # of the transposed data, and named afterwards; bars have to be drawn
+    # one dataset at a time.
+    if style == "histogram":
+        for dataset in range (0, nplots):
+            if key is not None:
+                lab = key[dataset]
+            else:
+                lab = None
             p.bar  (x, y[dataset], label=lab, align='center')
-        else:
-            p.plot (x, y[dataset], ls, label=lab)
+    else:
+        lines = p.plot (x, y.T, ls)
+        if key is not None:
+            for line, lab in zip (lines, key):
+                line.set_label (lab)
     if not key is None: p.legend ()
     p.show ()
 
@@ -5389,8 +5895,8 @@ def graph_pgfplots (x, y, fn, xlabel='x', ylabel='y', title=' ', logx=False,
             print (r"         \addplot[ybar interval] coordinates {", file=f)
         else:
             print (r"         \addplot[mark=%s] coordinates {" % mark, file=f)
-        for i in range (0, ny):
-            print ('          (%f, %f)' % (x[i], y[dataset,i]), file=f)
+        numpy.savetxt (f, numpy.column_stack ((x, y[dataset])),
+                       fmt='          (%f, %f)')
         print ('        };', file=f)
 
     # Finish the plot off.
@@ -5416,14 +5922,14 @@ def lpaxis (vmin, vmax, nincs):
         order -= 1
     step = step / 10.0**order
 
-    # Find the smallest value in preferred greater than step.
-    for p in range (0, npref):
-        if preferred[p] > step:
-            break
+    # Find the smallest value in preferred greater than step, settling
+    # for the largest if none is.
+    p = min (bisect.bisect_right (preferred, step), npref - 1)
+    scale = 10.0**order
 
     while True:
         # Regenerate step.
-        step = preferred[p] * 10**order
+        step = preferred[p] * scale
 
         # Set vlow to the next multiple of step below vmin.  This is the
         # smallest value which will appear on the axis, and we return it.
@@ -5441,6 +5947,7 @@ def lpaxis (vmin, vmax, nincs):
         if p >= npref:
             p = 0
             order += 1
+            scale = 10.0**order
     
     return origin, step, vlow
 
@@ -5474,7 +5981,6 @@ def lpgraph (x, y, xlabel, ylabel, title="", width=80, height=23,
     # Work out whether we're plotting one or several lines.
     nydims = 2 if isinstance (y[0], list) else 1
     if nydims == 1: y = [y]
-    nplots = len (y)
     ny = len (y[0])
 
     # If no x-values were given, provide some.
@@ -5483,22 +5989,16 @@ def lpgraph (x, y, xlabel, ylabel, title="", width=80, height=23,
         for ix in range (0, ny):
             x += [ix]
 
-    # Determine the extrema of the axes.
-    xmin = x[0]
-    xmax = x[0]
-    for xx in x:
-        if logx: xx = math.log10 (xx)
-        if xx < xmin: xmin = xx
-        if xx > xmax: xmax = xx
-
-    ymin = y[0][0]
-    ymax = y[0][0]
-    for p in range (0, nplots):
-        for i in range (0, ny):
-            yy = y[p][i]
-            if logy: yy = math.log10 (yy)
-            if yy < ymin: ymin = yy
-            if yy > ymax: ymax = yy
+    # Take the logarithms of the values if necessary, then determine the
+    # extrema of the axes.
+    xvals = [math.log10 (xx) for xx in x] if logx else x
+    xvals = numpy.array (xvals, dtype=float)
+    if logy: y = [[math.log10 (yy) for yy in yp] for yp in y]
+    yvals = numpy.array (y, dtype=float)
+    xmin = xvals.min ()
+    xmax = xvals.max ()
+    ymin = yvals.min ()
+    ymax = yvals.max ()
 
     # Work out the increments and origin positions on the axes.
     fstcol = nowid + 3
@@ -5526,6 +6026,9 @@ def lpgraph (x, y, xlabel, ylabel, title="", width=80, height=23,
     ytfst = height - (height-ylen) // 2
     ych = 0
 
+    # Work out the column in which each point is plotted once and for all.
+    cols = (numpy.round ((xvals - xmin) / xinc) + fstcol).astype (int)
+
     # We can now start to output the graph line by line.
     top = ymin + (nlines+1) * yinc
     for L in range (height, 0, -1):
@@ -5570,18 +6073,10 @@ def lpgraph (x, y, xlabel, ylabel, title="", width=80, height=23,
         # through all the y-values, inserting the relevant plotting point
         # into lpbuf if a value lines in the range [bot, top).
         if top >= ymin:
-            for p in range (0, nplots):
-                for i in range (0, ny):
-                    val = y[p][i]
-                    if logy: val = math.log10 (val)
-                    if style == "histogram" and val >= top:
-                        xx = math.log10 (x[i]) if logx else x[i]
-                        nch = int (round ((xx - xmin)/xinc) + fstcol)
-                        lpbuf[nch] = points[p]
-                    elif val >= bot and val < top:
-                        xx = math.log10 (x[i]) if logx else x[i]
-                        nch = int (round ((xx - xmin)/xinc) + fstcol)
-                        lpbuf[nch] = points[p]
+            mark = (yvals >= bot) & (yvals < top)
+            if style == "histogram": mark |= yvals >= top
+            for p, i in numpy.argwhere (mark):
+                lpbuf[cols[i]] = points[p]
 
         # Now output the line and prepare for the next one.
         line = "".join (lpbuf)
@@ -5621,11 +6116,9 @@ def lppic (im, using=["*       ", "@#+-    ", "#XXXX/' "], fd=sys.stdout,
     # set looks OK.
     chars = []
     if isinstance (using, str):
-        nover = 1
         chars.append(using)
     elif isinstance (using, list):
         chars = using
-        nover = len(using)
     else:
         raise ValueError ('Illegal argument type')
     nvals = len (chars[0])
@@ -5679,38 +6172,43 @@ def lppic (im, using=["*       ", "@#+-    ", "#XXXX/' "], fd=sys.stdout,
         print (ffc + sep, file=fd)
         ffc = ''
 
+    # Resample the image to the size of the output by bilinear interpolation,
+    # average all the channels to one and scale the values into the
+    # appropriate number of levels, all in one go.  The positions are
+    # accumulated exactly as they would be by stepping along the image, and
+    # the arithmetic is done in the same precision as for single pixels.
+    fy = numpy.full (ymax, yinc)
+    fy[:1] = 0.0
+    fy = numpy.cumsum (fy)
+    fx = numpy.full (xmax, xinc)
+    fx[:1] = 0.0
+    fx = numpy.cumsum (fx)
+    dy = (fy - fy.astype (int))[:,numpy.newaxis]
+    dx = (fx - fx.astype (int))[numpy.newaxis,:]
+    dy1 = 1.0 - dy
+    dx1 = 1.0 - dx
+    ylo = fy.astype (int) % ny
+    yhi = (ylo + 1) % ny
+    xlo = fx.astype (int) % nx
+    xhi = (xlo + 1) % nx
+    ft = numpy.result_type (im.dtype, 1.0)
+    w00 = (dx1 * dy1).astype (ft)
+    w01 = (dx  * dy1).astype (ft)
+    w10 = (dx1 * dy ).astype (ft)
+    w11 = (dx  * dy ).astype (ft)
+    v = numpy.empty ((ymax, xmax), dtype=ft)
+    resample = _jit (_lppic_kernel, fallback=_lppic_resample)
+    resample (v, im, ylo, yhi, xlo, xhi, w00, w01, w10, w11)
+    v /= nc
+    bufs = ((v - lo) * fac + 0.5).astype (int)
+    numpy.clip (bufs, 0, nvals - 1, out=bufs)
+
+    # Work out the complete overprinted sequence for each level just once.
+    glyphs = ['\b'.join ([c[i] for c in chars]) for i in range (0, nvals)]
+
     # Print the image.
-    buf = numpy.zeros (xmax, int)
-    fy = 0
     for y in range (0, ymax):
-        dy = fy - int(fy)
-        dy1 = 1.0 - dy
-        ylo = int(fy) % ny
-        yhi = (ylo + 1) % ny
-        ib = -1
-        # For each pixel along a line, average all the channels to one and
-        # scale the value into the appropriate number of levels.
-        fx = 0
-        for x in range (0, xmax):
-            dx = fx - int(fx)
-            dx1 = 1.0 - dx
-            xlo = int(fx) % nx
-            xhi = (xlo + 1) % nx
-            v = 0
-            for c in range (0, nc):
-                vc = dx1 * dy1 * im[ylo,xlo,c] + \
-                     dx  * dy1 * im[ylo,xhi,c] + \
-                     dx1 * dy  * im[yhi,xlo,c] + \
-                     dx  * dy  * im[yhi,xhi,c]
-                v += vc
-            v /= nc
-            v = int ((v - lo) * fac + 0.5)
-            if v < 0:      v = 0
-            if v >= nvals: v = nvals - 1
-            ib += 1
-            buf[ib] = v
-            fx += xinc
-        fy += yinc
+        buf = bufs[y].tolist ()
 
         # Print the line, including the borders if appropriate.  The traditional
         # way of doing this is as a series of lines using the carriage return
@@ -5724,10 +6222,7 @@ def lppic (im, using=["*       ", "@#+-    ", "#XXXX/' "], fd=sys.stdout,
         else:              mark = ' '
         line = ' '
         if doW: line = mark
-        for x in range (0, len(buf)):
-            for ov in range (0, nover-1):
-                line += chars[ov][buf[x]] + '\b'
-            line += chars[nover-1][buf[x]]
+        line += ''.join ([glyphs[i] for i in buf])
         if doE: line += mark
         print (ffc + line, file=fd)
         ffc = ''
@@ -7,12 +7,8 @@ def mean (im):
     ny, nx, nc = im.shape
     print (ny, nx, nc)
 
-    sum = 0
-    for y in range (0, ny):
-        for x in range (0, nx):
-            for c in range (0, nc):
-                sum = sum + im[y,x,c]
-    return sum / (ny * nx * nc)
+    # numpy sums all the pixels in C rather than one at a time in Python.
+    return float (im.mean ())
 
 
 # The following list of numbers is used to create a known image, one for which
@@ -31,8 +27,9 @@ vals = [13, 12, 6, 4, 8, 6, 12, 4, 7, 9, 14, 8, 4, 12, 9, 4,
         5, 4, 5, 15, 10, 9, 11, 6, 6, 10, 0, 3, 5, 3, 10, 6]
 
 # Convert the list of numbers into an image.  We'll use the same 8 unsigned
-# bits per pixel that images read in by OpenCV normally use.
-im = numpy.array (vals, dtype=numpy.uint8).reshape (12, 16, 1)
+# bits per pixel that images read in by OpenCV normally use, so the numbers
+# can be packed into bytes and the image made from them in a single copy.
+im = numpy.frombuffer (bytearray (vals), dtype=numpy.uint8).reshape (12, 16, 1)
 
 # Read in the image given on the command line.  Images read in by OpenCV are
 # stored in numpy structures, normally with 8 unsigned bits per pixel.
@@ -42,7 +39,9 @@ im = cv2.imread (sys.argv[1])
 ave = mean (im)
 print (ave)
 
-# Display the image.
-cv2.imshow ("have a go", im)
-cv2.waitKey (0)
+# Display the image if "--show" was given after the image's name, waiting for
+# a key to be pressed before exiting.
+if "--show" in sys.argv[2:]:
+    cv2.imshow ("have a go", im)
+    cv2.waitKey (0)
 